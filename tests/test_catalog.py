@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+from wdpipe.photometry.aperture_phot import get_catalog
+
+
+def _star_field(path, n_stars=60, shape=(300, 300), fwhm=3.0, seed=0):
+    """Write a FITS image with gaussian stars over a noisy sky"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.indices(shape)
+    sigma = fwhm/2.3548
+
+    data = rng.normal(100, 5, shape)
+    for x, y, flux in zip(rng.uniform(10, shape[1] - 10, n_stars),
+                          rng.uniform(10, shape[0] - 10, n_stars),
+                          rng.uniform(2e3, 2e4, n_stars)):
+        data += flux/(2*np.pi*sigma**2)*np.exp(-((xx - x)**2 + (yy - y)**2)/(2*sigma**2))
+
+    fits.writeto(path, data.astype(np.float32))
+
+
+def test_untiled_catalog_not_taken_from_tiled_cache(tmp_path):
+    image = tmp_path / "ref.fits"
+    _star_field(image)
+    pars = pd.Series({"FWHM": 3.0, "bkg_sky": 100.0, "sky_sigma": 5.0})
+
+    get_catalog(str(image), pars, tile_size=128, cache=True)
+    cached, _ = get_catalog(str(image), pars, tile_size=None, cache=True)
+    fresh, _ = get_catalog(str(image), pars, tile_size=None, cache=False)
+
+    np.testing.assert_allclose(cached, fresh)
+
+
+def test_catalog_cache_hit(tmp_path):
+    image = tmp_path / "ref.fits"
+    _star_field(image)
+    pars = pd.Series({"FWHM": 3.0, "bkg_sky": 100.0, "sky_sigma": 5.0})
+
+    first, _ = get_catalog(str(image), pars, tile_size=128, cache=True)
+    second, _ = get_catalog(str(image), pars, tile_size=128, cache=True)
+
+    assert len(list((tmp_path / ".catalog_cache").iterdir())) == 1
+    np.testing.assert_allclose(first, second)
@@ -20,7 +20,12 @@ OBS:
     pixel coordinate (integers with pixel positions)
 """
 import os
+import json
+import hashlib
+import sqlite3
 from glob import glob
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 import numpy as np
@@ -28,13 +33,64 @@ import matplotlib.pyplot as plt
 import pandas as pd
 from astropy.modeling.models import Moffat1D
 from astropy.modeling.fitting import LevMarLSQFitter
-from astropy.io import fits
 from photutils.centroids import centroid_1dg
 
 
 from wdpipe.utils.context_managers import indir
+from wdpipe.utils.fits_io import load_frame, file_hash
 
-def get_stats(img_matrix, take=["min", "max", "mean", "median", "std"]):
+#  Statistics returned by get_stats and fast_stats
+STATS = ["min", "max", "mean", "median", "std"]
+
+#  Per file parameters cache kept inside the images folder
+CACHE_NAME = ".inspection_cache.sqlite"
+
+
+def fast_stats(data, ndim=2, take=STATS):
+    """
+    Basic statistics over the last `ndim` axes of an array (e.g. each frame
+    of a (frames, y, x) stack or each stamp of a (frames, positions, h, w)
+    one). A single np.partition gives min, max and median and a single sum
+    of the median subtracted values gives mean and std.
+
+    Args:
+        data -- Numpy array.
+        ndim -- Integer with the number of trailing axes to reduce.
+        take -- List containing statistics to take, default is all stats.
+
+    Return:
+        Dict of numpy arrays (or floats when ndim covers the whole array)
+        with the statistics.
+    """
+    data = np.asarray(data)
+    lead = data.shape[:data.ndim - ndim]
+    flat = data.reshape(lead + (-1,))
+    n = flat.shape[-1]
+
+    middle = n // 2
+    kth = sorted({0, n - 1, middle, middle - 1 if n % 2 == 0 else middle})
+    part = np.partition(flat, kth, axis=-1)
+
+    if n % 2 == 0:
+        median = (part[..., middle - 1].astype(np.float64) + part[..., middle])/2
+    else:
+        median = part[..., middle].astype(np.float64)
+
+    results = {"min": part[..., 0], "max": part[..., n - 1], "median": median}
+    del part
+
+    if "mean" in take or "std" in take:
+        dev = flat - median[..., None]
+        mean_dev = dev.sum(axis=-1, dtype=np.float64)/n
+        var = (dev*dev).sum(axis=-1, dtype=np.float64)/n - mean_dev**2
+
+        results["mean"] = median + mean_dev
+        results["std"] = np.sqrt(np.maximum(var, 0))
+
+    return {stat: results[stat] for stat in take}
+
+
+def get_stats(img_matrix, take=STATS):
     """
     Given image matrice return basic stats of pixel count. Can do so for any
     array.
@@ -47,20 +103,91 @@ def get_stats(img_matrix, take=["min", "max", "mean", "median", "std"]):
         img_stats -- List with statistics of image in the order of the take
         list.
     """
+    img_stats = fast_stats(img_matrix, ndim=np.ndim(img_matrix), take=take)
+
+    return {stat: np.asarray(value).item() for stat, value in img_stats.items()}
+
+
+def extract_stamps(frames, xs, ys, delta=8):
+    """
+    Extract square stamps of size 2*delta (as get_square) around all the xy
+    positions of one frame or of a stack of frames with a single fancy
+    indexing.
+
+    Args:
+        frames -- Numpy array (..., y, x) with one image or a stack.
+        xs -- List of x positions
+        ys -- List of y positions
+        delta -- Integer for window size
+
+    Return:
+        Numpy array (..., positions, 2*delta, 2*delta) with the stamps.
+    """
+    xs = np.asarray(xs, dtype=int)
+    ys = np.asarray(ys, dtype=int)
+
+    if len(xs) != len(ys):
+        raise ValueError("x and y length doesn't match")
 
-    stats = {"min": np.min,
-             "max": np.max,
-             "mean": np.mean,
-             "median": np.median,
-             "std": np.std}
+    ny, nx = np.shape(frames)[-2:]
+    if len(xs) and (xs.min() < delta or ys.min() < delta
+                    or xs.max() + delta > nx or ys.max() + delta > ny):
+        raise ValueError(f"Stamps of size {2*delta} fall outside the image")
 
-    img_stats = {}
-    for stat in take:
-        img_stats[stat] = np.apply_along_axis(stats[stat],
-                                              0,  # Axis
-                                              np.ravel(img_matrix)).item()
+    offsets = np.arange(-delta, delta)
+    rows = (ys[:, None] + offsets)[:, :, None]
+    cols = (xs[:, None] + offsets)[:, None, :]
 
-    return img_stats
+    return np.asarray(frames)[..., rows, cols]
+
+
+def sky_from_stamps(stamps):
+    """
+    Sky level and sigma from stacks of sky stamps, as get_sky does: median
+    of the per pixel median and standard deviation across the stamps.
+
+    Args:
+        stamps -- Numpy array (..., positions, h, w) with sky stamps.
+
+    Return:
+        bkg_sky, sky_sigma -- Numpy arrays (...).
+    """
+    lead = stamps.shape[:-3]
+    stamps = stamps.reshape(lead + (stamps.shape[-3], -1))
+
+    sky = np.median(np.median(stamps, axis=-2), axis=-1)
+    sigma = np.median(stamps.std(axis=-2), axis=-1)
+
+    return sky, sigma
+
+
+def stamp_table(frames, xs, ys, delta=8, take=STATS):
+    """
+    Statistics of the stamps around the xy positions on a stack of frames.
+
+    Args:
+        frames -- Numpy array (frames, y, x).
+        xs -- List of x positions
+        ys -- List of y positions
+        delta -- Integer for window size
+        take -- List containing statistics to take, default is all stats.
+
+    Return:
+        Pandas DataFrame with one row per frame and position (columns frame,
+        position, x, y and the statistics).
+    """
+    stamps = extract_stamps(frames, xs, ys, delta)
+    n_frames, n_pos = stamps.shape[:2]
+
+    table = {"frame": np.repeat(np.arange(n_frames), n_pos),
+             "position": np.tile(np.arange(n_pos), n_frames),
+             "x": np.tile(np.asarray(xs), n_frames),
+             "y": np.tile(np.asarray(ys), n_frames)}
+
+    for stat, values in fast_stats(stamps, ndim=2, take=take).items():
+        table[stat] = np.ravel(values)
+
+    return pd.DataFrame(table)
 
 
 def get_square(img_matrix, x0, y0, delta=8):
@@ -84,8 +211,8 @@ def get_square(img_matrix, x0, y0, delta=8):
 
 def get_sky(img_matrix, xs, ys, delta = 8):
     """
-    Uses the get_square to extract patches pointed as xy pairs and calculate
-    the sigma.  Meant to estimate sky sigma.
+    Uses the extract_stamps to extract patches pointed as xy pairs and
+    calculate the sigma.  Meant to estimate sky sigma.
 
     Args:
         img_matrix -- 2D numpy array of image.
@@ -101,15 +228,9 @@ def get_sky(img_matrix, xs, ys, delta = 8):
         print("Warning !!! : x and y length doesn't match!! Exiting function.")
         return None
 
-    squares = []
-    for i, j in zip(xs, ys):
-        squares.append(get_square(img_matrix, i, j, delta))
-
-    squares = np.array(squares)
-    stds = squares.std(axis=0)
-    sky = np.median(squares, axis=0)
+    bkg_sky, sky_sigma = sky_from_stamps(extract_stamps(img_matrix, xs, ys, delta))
 
-    return {"bkg_sky": np.median(sky), "sky_sigma": np.median(stds)}
+    return {"bkg_sky": bkg_sky.item(), "sky_sigma": sky_sigma.item()}
 
 
 def mfwhm(star_matrix, sky=0, delta=8, plot=False):
@@ -156,16 +277,246 @@ def mfwhm(star_matrix, sky=0, delta=8, plot=False):
     return model_fit.fwhm
 
 
-def get_mfwhm(img_matrix, xs, ys, sky=0, delta=8):
+def _levmar_batch(model, x, y, p0, max_iter=100, tol=1e-8):
     """
-    Uses the get_square to extract patches with stars pointed using xy pairs.
-    Then extract mfwhm from each
+    Vectorized Levenberg-Marquardt fitting N independent data sets at once.
+
+    Args:
+        model -- Function (x, p) -> (f, jacobian) with x (N, M), p (N, P),
+                 f (N, M) and jacobian (N, M, P).
+        x -- Numpy array (N, M) with the independent variable.
+        y -- Numpy array (N, M) with the data.
+        p0 -- Numpy array (N, P) with the initial parameters.
+        max_iter -- Integer with the maximum number of iterations.
+        tol -- Float with the relative cost change to stop.
+
+    Return:
+        Numpy array (N, P) with the fitted parameters.
+    """
+    p = np.array(p0, dtype=np.float64)
+    n, n_pars = p.shape
+    lam = np.full(n, 1e-3)
+
+    f, jac = model(x, p)
+    cost = ((y - f)**2).sum(axis=1)
+    active = np.isfinite(cost)
+
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+
+        J = jac[idx]
+        JTJ = np.einsum("nmi,nmj->nij", J, J)
+        grad = np.einsum("nmi,nm->ni", J, y[idx] - f[idx])
+
+        diagonal = np.einsum("nii->ni", JTJ)
+        H = JTJ + (lam[idx, None]*diagonal + 1e-12)[:, :, None]*np.eye(n_pars)
+        step = np.einsum("nij,nj->ni", np.linalg.pinv(H), grad)
+
+        p_new = p[idx] + step
+        f_new, jac_new = model(x[idx], p_new)
+        cost_new = ((y[idx] - f_new)**2).sum(axis=1)
+
+        better = np.isfinite(cost_new) & (cost_new < cost[idx])
+        improved = idx[better]
+        converged = better & ((cost[idx] - cost_new) <= tol*cost[idx])
+
+        p[improved] = p_new[better]
+        f[improved] = f_new[better]
+        jac[improved] = jac_new[better]
+        cost[improved] = cost_new[better]
+
+        lam[improved] = np.maximum(lam[improved]/10, 1e-12)
+        lam[idx[~better]] *= 10
+
+        active[idx[converged]] = False
+        active[idx[~better & (lam[idx] > 1e12)]] = False
+
+    return p
+
+
+def _gaussian_and_jacobian(x, p):
+    """
+    Gaussian1D model (amplitude, mean, stddev) evaluated on x (N, M) for N
+    parameter sets p (N, 3), and its jacobian (N, M, 3).
+    """
+    amplitude, mean, stddev = (p[:, i, None] for i in range(3))
+
+    u = (x - mean)/stddev
+    g = np.exp(-0.5*u**2)
+    f = amplitude*g
+
+    jacobian = np.stack([g, f*u/stddev, f*u**2/stddev], axis=-1)
+
+    return f, jacobian
+
+
+def _moffat_and_jacobian(r, p):
+    """
+    Moffat1D model (amplitude, x_0, gamma, alpha) evaluated on r (N, M) for
+    N parameter sets p (N, 4), and its jacobian (N, M, 4).
+    """
+    amplitude, x_0, gamma, alpha = (p[:, i, None] for i in range(4))
+
+    u = (r - x_0)/gamma
+    q = 1 + u**2
+    qa = q**(-alpha)
+    f = amplitude*qa
+
+    jacobian = np.stack([qa,
+                         2*amplitude*alpha*u*qa/(q*gamma),
+                         2*amplitude*alpha*u**2*qa/(q*gamma),
+                         -f*np.log(q)], axis=-1)
+
+    return f, jacobian
+
+
+def _marginal_gaussian_means(marginals):
+    """
+    Means of 1D Gaussians fitted to N marginal distributions (N, M) at once,
+    starting from their moments as centroid_1dg does.
+    """
+    n, m = marginals.shape
+    x = np.broadcast_to(np.arange(m, dtype=np.float64), (n, m))
+
+    total = marginals.sum(axis=1)
+    total = np.where(total != 0, total, 1)
+    mean = (x*marginals).sum(axis=1)/total
+    stddev = np.sqrt(np.abs((marginals*(x - mean[:, None])**2).sum(axis=1)/total))
+    amplitude = np.ptp(marginals, axis=1)
+
+    p = _levmar_batch(_gaussian_and_jacobian, x, marginals,
+                      np.column_stack([amplitude, mean, stddev]))
+
+    return p[:, 1]
+
+
+def batch_centroids(stamps):
+    """
+    Vectorized centroid_1dg: centroids of a stack of stamps by fitting 1D
+    Gaussians to the x and y marginal distributions of all stamps at once.
+
+    Args:
+        stamps -- Numpy array (..., h, w) of sky subtracted stamps.
+
+    Return:
+        tx, ty -- Numpy arrays (...) with the x and y centroids in stamp
+                  pixel coordinates.
+    """
+    stamps = np.asarray(stamps, dtype=np.float64)
+    lead, (h, w) = stamps.shape[:-2], stamps.shape[-2:]
+
+    tx = _marginal_gaussian_means(stamps.sum(axis=-2).reshape(-1, w))
+    ty = _marginal_gaussian_means(stamps.sum(axis=-1).reshape(-1, h))
+
+    return tx.reshape(lead), ty.reshape(lead)
+
+
+def fit_moffat_batch(r, y, max_iter=100):
+    """
+    Fit a Moffat1D profile to N radial profiles at once, starting as mfwhm
+    does (amplitude=max, x_0=0, gamma=1, alpha=1).
+
+    Args:
+        r -- Numpy array (N, M) with the distances to the center.
+        y -- Numpy array (N, M) with the counts.
+        max_iter -- Integer with the maximum number of iterations.
+
+    Return:
+        Numpy array (N, 4) with amplitude, x_0, gamma and alpha.
+    """
+    r = np.asarray(r, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+
+    p0 = np.column_stack([y.max(axis=1), np.zeros(n), np.ones(n), np.ones(n)])
+
+    return _levmar_batch(_moffat_and_jacobian, r, y, p0, max_iter=max_iter)
+
+
+def batch_mfwhm(stamps, sky=0):
+    """
+    Vectorized version of mfwhm for a stack of star stamps of any leading
+    shape, e.g. (frames, stars, h, w): the centers come from batch_centroids
+    and all the radial profiles are fitted at once with fit_moffat_batch.
+
+    Args:
+        stamps -- Numpy array (..., h, w) with star stamps.
+        sky -- Float or array broadcastable to the leading shape with the sky
+               background. Where it is 0 the stamp minimum is used (as in
+               mfwhm).
+
+    Return:
+        Numpy array (...) with the FWHM of each stamp.
+    """
+    stamps = np.asarray(stamps, dtype=np.float64)
+    lead, (h, w) = stamps.shape[:-2], stamps.shape[-2:]
+
+    sky = np.broadcast_to(np.asarray(sky, dtype=np.float64), lead)
+    sky = np.where(sky == 0, stamps.min(axis=(-2, -1)), sky)
+
+    stars = stamps - sky[..., None, None]
+    tx, ty = batch_centroids(stars)
+
+    yy, xx = np.ogrid[:h, :w]
+    dist = np.sqrt((ty[..., None, None] - yy)**2 + (tx[..., None, None] - xx)**2)
+
+    p = fit_moffat_batch(dist.reshape(-1, h*w), stars.reshape(-1, h*w))
+    gamma, alpha = p[:, 2], p[:, 3]
+
+    fwhm = 2*np.abs(gamma)*np.sqrt(2**(1/alpha) - 1)
+
+    return fwhm.reshape(lead)
+
+
+def compare_fwhm(img_matrix, xs, ys, sky=0, delta=8, rtol=0.05):
+    """
+    Tolerance check of batch_mfwhm against the per star mfwhm fit on one
+    image.
+
+    Args:
+        img_matrix -- 2D numpy array of image.
+        xs -- List of x positions
+        ys -- List of y positions
+        sky -- Float giving sky background counts.
+        delta -- Integer for window size
+        rtol -- Float with the accepted relative difference.
+
+    Return:
+        Pandas DataFrame with x, y, both FWHM, relative difference and a
+        boolean column "ok". Stars where mfwhm fails have NaN there.
+    """
+    squares = extract_stamps(img_matrix, xs, ys, delta)
+
+    fitted = []
+    for star in squares:
+        try:
+            fitted.append(mfwhm(star, sky, delta))
+        except Exception:
+            fitted.append(np.nan)
+
+    fitted = np.array(fitted)
+    batch = batch_mfwhm(squares, sky)
+
+    diff = np.abs(batch - fitted)/np.abs(fitted)
+
+    return pd.DataFrame({"x": list(xs), "y": list(ys), "mfwhm": fitted,
+                         "batch_mfwhm": batch, "rel_diff": diff, "ok": diff <= rtol})
+
+
+def get_mfwhm(img_matrix, xs, ys, sky=0, delta=8, method="batch"):
+    """
+    Uses the extract_stamps to extract patches with stars pointed using xy
+    pairs. Then extract mfwhm from each
 
     Args:
         img_matrix -- 2D numpy array of image.
         xs -- List of x positions
         ys -- List of y positions
         delta -- Integer for window size
+        method -- "batch" (default) to fit all stars at once with
+                  batch_mfwhm or "fit" to fit each one with mfwhm.
 
     Return:
         Float giving fwhm average of all points
@@ -174,9 +525,10 @@ def get_mfwhm(img_matrix, xs, ys, sky=0, delta=8):
         print("Warning !!! : x and y length doesn't match!! Exiting function.")
         return None
 
-    squares = []
-    for i, j in zip(xs, ys):
-        squares.append(get_square(img_matrix, i, j, delta))
+    squares = extract_stamps(img_matrix, xs, ys, delta)
+
+    if method == "batch":
+        return np.mean(batch_mfwhm(squares, sky))
 
     estimatives = []
     for star in squares:
@@ -185,6 +537,52 @@ def get_mfwhm(img_matrix, xs, ys, sky=0, delta=8):
     return np.mean(estimatives)
 
 
+def get_stack_parameters(images, ref_stars_x, ref_stars_y, ref_sky_x, ref_sky_y, delta=8):
+    """
+    Parameters for inspection (basic stats + background sky + sky sigma +
+    FWHM) of a list of images. Each image is read once to take its stats and
+    its stamps; sky and FWHM are then computed for the whole stack of stamps
+    at once.
+
+    Args:
+        images -- List of strings with paths to the images to analise.
+        ref_stars_x -- List of Ints with x coordinate to star center pixel.
+        ref_stars_y -- List of Ints with x coordinate to star center pixel.
+        ref_sky_x -- List of Ints with x coordinate to sky pixel.
+        ref_sky_y -- List of Ints with x coordinate to sky pixel.
+        delta -- Integer for window size
+
+    Return:
+        List of dictionaries (one per image, as get_image_parameters).
+    """
+    rows = []
+    star_stamps = []
+    sky_stamps = []
+
+    for image in images:
+        data, header = load_frame(image)
+
+        info = {"file": image.split("/")[-1],
+                "jd": header["JD"],
+                "airmass": header["AIRMASS"]}
+        info.update(get_stats(data))
+
+        rows.append(info)
+        star_stamps.append(extract_stamps(data, ref_stars_x, ref_stars_y, delta))
+        sky_stamps.append(extract_stamps(data, ref_sky_x, ref_sky_y, delta))
+
+    if not rows:
+        return rows
+
+    bkg_sky, sky_sigma = sky_from_stamps(np.array(sky_stamps))
+    fwhm = batch_mfwhm(np.array(star_stamps), bkg_sky[:, None]).mean(axis=1)
+
+    for info, sky, sigma, f in zip(rows, bkg_sky, sky_sigma, fwhm):
+        info.update({"bkg_sky": sky.item(), "sky_sigma": sigma.item(), "FWHM": f.item()})
+
+    return rows
+
+
 def get_image_parameters(image, ref_stars_x, ref_stars_y, ref_sky_x, ref_sky_y):
     """
     Given an image, return the parameters for inspection (basic stats +
@@ -201,48 +599,148 @@ def get_image_parameters(image, ref_stars_x, ref_stars_y, ref_sky_x, ref_sky_y):
         Dictionary containing image information, basic stats and basic
         parameters.
     """
+    return get_stack_parameters([image], ref_stars_x, ref_stars_y, ref_sky_x, ref_sky_y)[0]
 
-    data = fits.getdata(image)
-    header = fits.getheader(image)
 
-    info = {"file": image.split("/")[-1],
-            "jd": header["JD"],
-            "airmass": header["AIRMASS"]}
+def _refs_key(ref_stars_x, ref_stars_y, ref_sky_x, ref_sky_y, delta):
+    """Key identifying a set of reference positions. (lists -> str)"""
+    refs = [[int(v) for v in values] for values in
+            (ref_stars_x, ref_stars_y, ref_sky_x, ref_sky_y)] + [int(delta)]
 
-    info.update(get_stats(data))
-    info.update(get_sky(data, ref_sky_x, ref_sky_y))
-    info["FWHM"] = get_mfwhm(data, ref_stars_x, ref_stars_y, sky=info["bkg_sky"])
-    return info
+    return hashlib.blake2b(json.dumps(refs).encode(), digest_size=16).hexdigest()
 
 
-def get_parameters_all(folder, ref_stars_x, ref_stars_y, ref_sky_x, ref_sky_y):
+def _open_cache(folder):
+    """
+    Open (creating if needed) the parameters cache of a folder.
+    (str -> sqlite3.Connection)
+    """
+    con = sqlite3.connect(Path(folder) / CACHE_NAME)
+    con.execute("""CREATE TABLE IF NOT EXISTS parameters (
+                       file TEXT,
+                       refs TEXT,
+                       size INTEGER,
+                       mtime INTEGER,
+                       hash TEXT,
+                       parameters TEXT,
+                       PRIMARY KEY (file, refs))""")
+    return con
+
+
+def _chunk_parameters(files, refs, hashes=True):
+    """
+    get_stack_parameters of a chunk of files and, if `hashes`, the content
+    hash of each file, computed by the same process that just read it.
+    (list, list, bool -> list of dicts, list of str)
+    """
+    rows = get_stack_parameters(files, *refs)
+    digests = [file_hash(file) for file in files] if hashes else [None]*len(files)
+
+    return rows, digests
+
+
+def get_parameters_all(folder, ref_stars_x, ref_stars_y, ref_sky_x, ref_sky_y,
+                       n_jobs=1, use_cache=True, chunk_size=32):
     """
     Return and write a Data Frame with parameters extracted with
     get_image_parameters for all images in a folder.
 
+    Parameters of each file are kept on a cache inside the folder (file
+    named CACHE_NAME) keyed by the file name, the reference positions and
+    the file size, modification time and content hash, so a re-run only
+    processes new or changed files (a file with new modification time but
+    same content is not processed again).
+
     Args:
         folder -- String with path to folder
         ref_stars_x -- List of Ints with x coordinate to star center pixel.
         ref_stars_y -- List of Ints with x coordinate to star center pixel.
         ref_sky_x -- List of Ints with x coordinate to sky pixel.
         ref_sky_y -- List of Ints with x coordinate to sky pixel.
+        n_jobs -- Integer with the number of processes.
+        use_cache -- Boolean, if False every file is processed and the
+                     cache is left untouched.
+        chunk_size -- Integer with the maximum number of files processed
+                      together by get_stack_parameters.
 
     Return:
         Pandas Dataframe containing information on all fits files of the folder
     """
+    refs = [list(ref_stars_x), list(ref_stars_y), list(ref_sky_x), list(ref_sky_y)]
+    key = _refs_key(*refs, delta=8)
+
     with indir(folder):
 
         files = glob("*.fits")
         files.sort()
 
-        N = len(files)
-
-        dicts = []
-        for i, image in enumerate(files, start=1):
-            print(f"Getting parameters for file: {image} ({i} of {N})")
-            dicts.append(get_image_parameters(image, ref_stars_x, ref_stars_y, ref_sky_x, ref_sky_y))
-
-        df = pd.DataFrame(dicts)
+        cached = {}
+        if use_cache:
+            con = _open_cache(".")
+            cached = {file: (size, mtime, digest, pars) for file, size, mtime, digest, pars
+                      in con.execute("""SELECT file, size, mtime, hash, parameters
+                                        FROM parameters WHERE refs = ?""", (key,))}
+
+        dicts = {}
+        pending = []
+        updates = []
+        for file in files:
+            entry = cached.pop(file, None)
+
+            if entry is not None:
+                stat = os.stat(file)
+                if entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                    dicts[file] = json.loads(entry[3])
+                    continue
+
+                digest = file_hash(file)
+                if entry[2] == digest:
+                    dicts[file] = json.loads(entry[3])
+                    updates.append((file, key, stat.st_size, stat.st_mtime_ns, digest, entry[3]))
+                    continue
+
+            pending.append(file)
+
+        N = len(pending)
+        print(f"Getting parameters for {N} of {len(files)} files")
+
+        chunks = [pending[i:i + chunk_size] for i in range(0, N, chunk_size)]
+        done = 0
+
+        def report(chunk, result):
+            nonlocal done
+            done += len(chunk)
+            print(f"Got parameters for {chunk[0]} ... {chunk[-1]} ({done} of {N})")
+
+            for file, row, digest in zip(chunk, *result):
+                dicts[file] = row
+                if use_cache:
+                    stat = os.stat(file)
+                    updates.append((file, key, stat.st_size, stat.st_mtime_ns,
+                                    digest, json.dumps(row)))
+
+        if n_jobs <= 1:
+            for chunk in chunks:
+                report(chunk, _chunk_parameters(chunk, refs, hashes=use_cache))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                futures = {pool.submit(_chunk_parameters,
+                                       [os.path.abspath(file) for file in chunk], refs,
+                                       hashes=use_cache): chunk
+                           for chunk in chunks}
+                for future in as_completed(futures):
+                    report(futures[future], future.result())
+
+        if use_cache:
+            with con:
+                con.executemany("INSERT OR REPLACE INTO parameters VALUES (?, ?, ?, ?, ?, ?)",
+                                updates)
+                stale = {file for (file,) in con.execute("SELECT DISTINCT file FROM parameters")}
+                con.executemany("DELETE FROM parameters WHERE file = ?",
+                                [(file,) for file in stale.difference(files)])
+            con.close()
+
+        df = pd.DataFrame([dicts[file] for file in files])
 
     print("\nFinished getting parameters!")
 
@@ -256,18 +754,21 @@ def get_parameters_all(folder, ref_stars_x, ref_stars_y, ref_sky_x, ref_sky_y):
     return df
 
 
-def inspect(image_folder, ref_file, out_name):
+def inspect(image_folder, ref_file, out_name, n_jobs=1):
     """
     Given a folder with aligned images, a file containing the position for sky
     and star patches and a output name, create a file containing a dataset
     with parameters extracted from the images.
 
-    OBS: Basically parse the ref_file and pass to get_parameters_all.
+    OBS: Basically parse the ref_file and pass to get_parameters_all. Files
+    already processed with the same refs are taken from the cache of the
+    folder, so a re-run only processes new or changed images.
 
     Args:
         image_folder -- str with path to folder
         ref_file -- str with path to file
         out_name -- str with name to give to the exit file
+        n_jobs -- int with the number of processes
 
     Returns:
         parameters -- pd.DataFrame with the parameters extracted from the
@@ -283,7 +784,7 @@ def inspect(image_folder, ref_file, out_name):
     stars = ref_df.loc[ref_df.kind == "star"]
     sky = ref_df.loc[ref_df.kind == "sky"]
 
-    parameters = get_parameters_all(image_folder, stars.x, stars.y, sky.x, sky.y)
+    parameters = get_parameters_all(image_folder, stars.x, stars.y, sky.x, sky.y, n_jobs=n_jobs)
 
     parameters.to_csv(out_name, index=False)
 
@@ -1,20 +1,104 @@
 """
 Functions to perform aperture photometry over a folder of FITS files.
 """
+import os
+import json
+import hashlib
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 from astropy.io import fits
-from photutils import DAOStarFinder
-from photutils import CircularAnnulus, CircularAperture
+from astropy.table import QTable, vstack
+from photutils.detection import DAOStarFinder
 
 from wdpipe.utils.context_managers import indir
-import wfc3_photometry.photometry_tools.photometry_with_errors as phot
+from wdpipe.utils.fits_io import load_frame, open_frame, file_hash
+from wdpipe.photometry.iraf_phot import ApertureMatrix
+from wdpipe.inspection.inspect import batch_centroids
+from wdpipe.photometry.lightcurve_store import write_store
 
 
 
-def get_catalog(ref_image, pars, nsigma=5):
+#  Folder (next to the reference image) with the cached catalogs
+CATALOG_CACHE = ".catalog_cache"
+
+
+def _centroid_columns(sources):
+    """Names of the x, y centroid columns (renamed on photutils 3)"""
+    if "x_centroid" in sources.colnames:
+        return "x_centroid", "y_centroid"
+
+    return "xcentroid", "ycentroid"
+
+
+def tiled_detection(matrix, finder, tile_size=1024, margin=None, n_jobs=1):
+    """
+    Run a photutils star finder over an image in tiles with overlapping
+    margins, on a thread pool. Each source is kept only by the tile whose
+    core (tile without the margins) contains its centroid, so sources on
+    the overlaps are not duplicated.
+
+    Args:
+        matrix -- 2D numpy array with the image.
+        finder -- photutils star finder (e.g. DAOStarFinder).
+        tile_size -- Integer with the size of the tile cores in pixels.
+        margin -- Integer with the overlap in pixels, by default 4 FWHM
+                  (at least 16 pixels) so the finder sees each core source
+                  as on the whole image.
+        n_jobs -- Integer with the number of threads.
+
+    Return:
+        Table with the sources sorted by y, x and numbered from 1, or None
+        if no source is found.
+    """
+
+    if margin is None:
+        margin = max(16, int(np.ceil(4*finder.fwhm)))
+
+    ny, nx = matrix.shape
+    cores = [(y0, min(y0 + tile_size, ny), x0, min(x0 + tile_size, nx))
+             for y0 in range(0, ny, tile_size) for x0 in range(0, nx, tile_size)]
+
+    def detect(core):
+        y0, y1, x0, x1 = core
+        ty0, tx0 = max(y0 - margin, 0), max(x0 - margin, 0)
+
+        sources = finder(matrix[ty0:min(y1 + margin, ny), tx0:min(x1 + margin, nx)])
+        if sources is None:
+            return None
+
+        xcol, ycol = _centroid_columns(sources)
+        sources[xcol] += tx0
+        sources[ycol] += ty0
+
+        #  Pixel of each centroid (clipped to the image) decides the owner
+        px = np.clip(np.floor(np.asarray(sources[xcol]) + 0.5), 0, nx - 1)
+        py = np.clip(np.floor(np.asarray(sources[ycol]) + 0.5), 0, ny - 1)
+        own = (px >= x0) & (px < x1) & (py >= y0) & (py < y1)
+
+        return sources[own] if own.any() else None
+
+    if n_jobs <= 1:
+        tiles = [detect(core) for core in cores]
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            tiles = list(pool.map(detect, cores))
+
+    tiles = [tile for tile in tiles if tile is not None]
+    if not tiles:
+        return None
+
+    sources = vstack(tiles)
+    xcol, ycol = _centroid_columns(sources)
+    sources = sources[np.lexsort((sources[xcol], sources[ycol]))]
+    sources["id"] = np.arange(1, len(sources) + 1)
+
+    return sources
+
+
+def get_catalog(ref_image, pars, nsigma=5, tile_size=None, n_jobs=1, cache=True):
     """
     Detect sources in image and create catalog of id, x_center and y_center of
     stars.
@@ -24,34 +108,204 @@ def get_catalog(ref_image, pars, nsigma=5):
         pars -- Pandas Series with image parameters.
         nsigma -- Integer to multiply the sky sigma adding to the background
                   for threshold.
+        tile_size -- Integer with the tile size to detect in tiles on
+                     parallel (see tiled_detection) or None (default) to
+                     detect on the whole image at once.
+        n_jobs -- Integer with the number of threads for the tiles.
+        cache -- Boolean, if True the sources are cached on a folder next to
+                 the image (CATALOG_CACHE) keyed by the image content, the
+                 finder parameters and tile_size, so a rerun with the same
+                 parameters doesn't detect again.
 
     Return:
         positions -- 2D numpy array with catalog (Columns: 0 - ID; 1 - Xcenter; 2 - Ycenter)
         sources -- Table containing the source properties
     """
 
-    matrix = fits.getdata(ref_image)
+    finder_pars = {"fwhm": float(pars["FWHM"]),
+                   "threshold": float(pars["bkg_sky"] + nsigma*pars["sky_sigma"])}
+
+    cache_file = None
+    if cache:
+        #  The tiled detection orders and numbers the sources its own way
+        key = json.dumps([file_hash(ref_image), finder_pars, tile_size], sort_keys=True)
+        key = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        cache_file = os.path.join(os.path.dirname(os.path.abspath(ref_image)),
+                                  CATALOG_CACHE, f"{key}.ecsv")
+
+    if cache_file is not None and os.path.exists(cache_file):
+        sources = QTable.read(cache_file, format="ascii.ecsv")
+    else:
+        matrix = fits.getdata(ref_image)
 
-    finder = DAOStarFinder(fwhm=pars["FWHM"],
-                           threshold=pars["bkg_sky"] + nsigma*pars["sky_sigma"])
+        finder = DAOStarFinder(**finder_pars)
 
-    sources = finder(matrix)
+        if tile_size is None:
+            sources = finder(matrix)
+        else:
+            sources = tiled_detection(matrix, finder, tile_size=tile_size, n_jobs=n_jobs)
 
+        if cache_file is not None and sources is not None:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            sources.write(cache_file, format="ascii.ecsv", overwrite=True)
+
+    xcol, ycol = _centroid_columns(sources)
     positions = np.transpose((
         sources["id"],
-        sources["xcentroid"],
-        sources["ycentroid"]))
+        sources[xcol],
+        sources[ycol]))
 
     return positions, sources
 
 
+def to_frame_positions(positions, transform):
+    """
+    Map reference positions into the pixel positions of a frame using the
+    transform solved with pre_processing.alignment.transform_with (which maps
+    frame positions into the reference).
+
+    Args:
+        positions -- 2D numpy array with x, y columns on the reference.
+        transform -- Pandas Series (or dict) with scale, rotation, tx and ty.
+
+    Return:
+        2D numpy array with x, y columns on the frame.
+    """
+
+    scale, rotation = transform["scale"], transform["rotation"]
+
+    matrix = np.array([[scale*np.cos(rotation), -scale*np.sin(rotation), transform["tx"]],
+                       [scale*np.sin(rotation), scale*np.cos(rotation), transform["ty"]],
+                       [0, 0, 1]])
+
+    homogeneous = np.column_stack([positions, np.ones(len(positions))])
+
+    return (np.linalg.inv(matrix) @ homogeneous.T).T[:, :2]
+
+
+def recenter_positions(data, positions, delta=4, max_shift=2.0):
+    """
+    Refine the positions of all stars on an image at once: stamps of size
+    2*delta + 1 around each position (minus their median) are centered with
+    inspection.inspect.batch_centroids (vectorized centroid_1dg). Stars whose
+    stamp falls outside the image, or that move more than `max_shift`
+    pixels, keep their position.
+
+    Args:
+        data -- 2D numpy array with the image, or any object accepting 2D
+                slices (e.g. the `section` of a FITS HDU).
+        positions -- 2D numpy array with x, y columns.
+        delta -- Integer with the half size of the stamps.
+        max_shift -- Float with the maximum accepted shift in pixels.
+
+    Return:
+        2D numpy array with the refined x, y columns.
+    """
+
+    positions = np.asarray(positions, dtype=np.float64)
+    refined = positions.copy()
+
+    ny, nx = data.shape
+    centers = np.round(positions).astype(int)
+    inside = ((centers[:, 0] >= delta) & (centers[:, 0] < nx - delta)
+              & (centers[:, 1] >= delta) & (centers[:, 1] < ny - delta))
+
+    if not inside.any():
+        return refined
+
+    ix, iy = centers[inside].T
+    offsets = np.arange(-delta, delta + 1)
+
+    if isinstance(data, np.ndarray):
+        stamps = data[(iy[:, None] + offsets)[:, :, None], (ix[:, None] + offsets)[:, None, :]]
+    else:
+        stamps = np.array([data[y - delta:y + delta + 1, x - delta:x + delta + 1]
+                           for x, y in zip(ix, iy)])
+
+    stamps = stamps.astype(np.float64)
+    stamps -= np.median(stamps.reshape(len(stamps), -1), axis=1)[:, None, None]
+
+    tx, ty = batch_centroids(stamps)
+    moved = np.column_stack([ix - delta + tx, iy - delta + ty])
+
+    shift = np.hypot(*(moved - positions[inside]).T)
+    good = np.isfinite(shift) & (shift <= max_shift)
+
+    refined[np.flatnonzero(inside)[good]] = moved[good]
+
+    return refined
+
+
+def measure_frame(image, positions, pars, aperture_factors, apertures=None, cutouts=False,
+                  recenter=False):
+    """
+    IRAF style photometry of positions on an image (see
+    iraf_phot.ApertureMatrix.photometry), with the non positive pixels
+    replaced by the sky sigma.
+
+    Args:
+        image -- String with path to the image.
+        positions -- 2D numpy array with x, y columns.
+        pars -- Pandas Series with image parameters.
+        aperture_factors -- Dict with factors to scale apertures in units of
+                            FWHM ("r" can be a list of factors).
+        apertures -- iraf_phot.ApertureMatrix for the positions and the
+                     image shape, a function of the image shape returning one
+                     (e.g. wrapping fwhm_apertures, so the shape comes from
+                     the same open as the pixels) or None (default) to build
+                     it.
+        cutouts -- Boolean, if True the frame is memory mapped (when
+                   possible) and only the boxes around the stars are read
+                   and clamped, otherwise the whole frame is loaded.
+        recenter -- Boolean, if True the positions are refined with
+                    recenter_positions before the photometry (the apertures
+                    are then always built for the refined positions).
+
+    Return:
+        Dict of numpy arrays with the photometry (X and Y with the
+        positions used).
+    """
+
+    fwhm = pars["FWHM"]
+
+    def build(shape):
+        if apertures is not None and not recenter:
+            return apertures(shape) if callable(apertures) else apertures
+
+        return ApertureMatrix(positions, shape,
+                              r=np.multiply(aperture_factors["r"], fwhm),
+                              r_in=aperture_factors["r_in"]*fwhm,
+                              r_out=aperture_factors["r_out"]*fwhm)
+
+    if cutouts:
+        with open_frame(image) as (hdu, header):
+            if recenter:
+                positions = recenter_positions(hdu.section, positions)
+            aperture_matrix = build(hdu.shape)
+            values = aperture_matrix.read_pixels(hdu.section)
+    else:
+        matrix, header = load_frame(image)
+        if recenter:
+            positions = recenter_positions(matrix, positions)
+        aperture_matrix = build(matrix.shape)
+        values = aperture_matrix.gather(matrix)
+
+    values[values <= 0] = pars["sky_sigma"]
+
+    #  IRAF style photometry (mode sky, errors with the gain as epadu)
+    return aperture_matrix.photometry_pixels(values, epadu=float(header["GAIN"]))
+
+
 def get_photometry(
         image,
         catalog,
         pars,
         aperture_factors={"r": 2.0, "r_in": 2.5, "r_out": 3.5},
         zero_point=25,
-        first=False):
+        first=False,
+        apertures=None,
+        cutouts=False,
+        recenter=False):
     """
     Use catalog to generate photometry table.
 
@@ -64,50 +318,183 @@ def get_photometry(
         first -- Boolean to indicate if it is the first of a time series.
                  If True return ID, X and Y positions on return in addition
                  to magnitude and error.
+        apertures -- iraf_phot.ApertureMatrix built for the catalog positions
+                     and this image shape, a function of the image shape
+                     returning one (see measure_frame), or None (default) to
+                     build it from the aperture factors.
+        cutouts -- Boolean, if True read only the boxes around the stars
+                   (see measure_frame).
+        recenter -- Boolean, if True refine the positions on the image
+                    before the photometry (see recenter_positions).
 
     Return:
         Numpy 2D array with table of photometry.
     """
 
-    #  Load data
-    matrix = fits.getdata(image)
-    header = fits.getheader(image)
-    fwhm = pars["FWHM"]
     positions = catalog[:, 1:]
     indexes = catalog[:, 0][:, None]
 
-    #  Create apertures
-    apertures = CircularAperture(positions,
-                                 r=aperture_factors["r"]*fwhm)
-    sky_annulus = CircularAnnulus(positions,
-                                  r_in=aperture_factors["r_in"]*fwhm,
-                                  r_out=aperture_factors["r_out"]*fwhm)
-
-    matrix[matrix <= 0] = pars["sky_sigma"]
-
-    photometry = phot.iraf_style_photometry(apertures,
-                                            sky_annulus,
-                                            matrix,
-                                            epadu=float(header["GAIN"]))
+    photometry = pd.DataFrame(measure_frame(image, positions, pars, aperture_factors,
+                                            apertures=apertures, cutouts=cutouts,
+                                            recenter=recenter))
 
     photometry["mag"] = zero_point + photometry["mag"]
 
     if first:
         #  ID, Xcenter, Ycenter, MAG, MERR
         return np.hstack([indexes,
-                          (photometry
-                           .to_pandas()[["X", "Y", "mag", "mag_error"]]
-                           .to_numpy())])
+                          photometry[["X", "Y", "mag", "mag_error"]].to_numpy()])
 
     # Xcenter, Ycenter
-    return photometry.to_pandas()[["mag", "mag_error"]].to_numpy()
+    return photometry[["mag", "mag_error"]].to_numpy()
+
+
+#  Catalog and tables of the photometry worker processes (see
+#  _init_photometry_worker)
+_worker_state = {}
+
+
+def _frame_catalog(catalog, transforms, image):
+    """Catalog with positions on the image (catalog -> catalog)"""
+    if transforms is None:
+        return catalog
+
+    moved = np.array(catalog, dtype=np.float64)
+    moved[:, 1:] = to_frame_positions(catalog[:, 1:], transforms.loc[image])
+    return moved
+
+
+def fwhm_apertures(cache, positions, shape, fwhm, aperture_factors, fwhm_step):
+    """
+    ApertureMatrix for a FWHM rounded to a multiple of `fwhm_step`, built once
+    per bucket and kept on the `cache` dict (only valid for a fixed catalog,
+    i.e. aligned images).
+
+    Args:
+        cache -- Dict used as cache (bucket -> ApertureMatrix).
+        positions -- 2D numpy array with x, y columns.
+        shape -- Tuple with the image shape.
+        fwhm -- Float with the FWHM of the frame.
+        aperture_factors -- Dict with factors to scale apertures in units of
+                            FWHM ("r" can be a list of factors).
+        fwhm_step -- Float with the bucket width in pixels.
+
+    Return:
+        ApertureMatrix.
+    """
+    bucket = int(round(fwhm/fwhm_step))
+
+    if (bucket, shape) not in cache:
+        fwhm = bucket*fwhm_step
+        cache[(bucket, shape)] = ApertureMatrix(positions, shape,
+                                                r=np.multiply(aperture_factors["r"], fwhm),
+                                                r_in=aperture_factors["r_in"]*fwhm,
+                                                r_out=aperture_factors["r_out"]*fwhm)
+
+    return cache[(bucket, shape)]
+
+
+def _frame_photometry(image, catalog, pars, transforms, aperture_factors,
+                      fwhm_step=None, cache=None, cutouts=False, recenter=False,
+                      zero_point=25):
+    """
+    Photometry of one image (path) of the series, looking up its parameters
+    and transform by file name. With `fwhm_step` the apertures come from
+    fwhm_apertures, with the shape of the open made by measure_frame.
+
+    Return:
+        2D numpy array with magnitude, error and the X, Y positions used.
+    """
+    name = os.path.basename(image)
+    frame_pars = pars.loc[name]
+    positions = _frame_catalog(catalog, transforms, name)[:, 1:]
+
+    apertures = None
+    if fwhm_step is not None:
+        def apertures(shape):
+            return fwhm_apertures(cache, positions, shape, frame_pars["FWHM"],
+                                  aperture_factors, fwhm_step)
+
+    photometry = measure_frame(image, positions, frame_pars, aperture_factors,
+                               apertures=apertures, cutouts=cutouts, recenter=recenter)
+
+    return np.column_stack([zero_point + photometry["mag"], photometry["mag_error"],
+                            photometry["X"], photometry["Y"]])
+
+
+def _frame_growth(image, catalog, pars, aperture_factors, fwhm_step=None, cache=None,
+                  zero_point=25, cutouts=False):
+    """
+    Magnitudes and errors (stars, radii) of one image (path) for all the
+    aperture radii factors on aperture_factors["r"], reading it once.
+    """
+    frame_pars = pars.loc[os.path.basename(image)]
+
+    apertures = None
+    if fwhm_step is not None:
+        def apertures(shape):
+            return fwhm_apertures(cache, catalog[:, 1:], shape, frame_pars["FWHM"],
+                                  aperture_factors, fwhm_step)
+
+    photometry = measure_frame(image, catalog[:, 1:], frame_pars, aperture_factors,
+                               apertures=apertures, cutouts=cutouts)
+
+    return zero_point + photometry["mag"], photometry["mag_error"]
+
+
+def _init_photometry_worker(func, state):
+    """
+    Pool initializer: keep the function to run, the catalog, parameters and
+    transforms once per worker, with its own cache of aperture matrices.
+    """
+    _worker_state.update(func=func, state=dict(state, cache={}))
+
+
+def _photometry_worker(item):
+    """Run the worker function on an (image, ...) item with the worker state"""
+    return _worker_state["func"](*item, **_worker_state["state"])
+
+
+def allocate_lightcurve(n_stars, n_frames, out_file=None):
+    """
+    Preallocate the light curve table (columns: ID, X, Y and a magnitude,
+    error pair per frame) filled with NaN.
+
+    Args:
+        n_stars -- Integer with the number of stars on the catalog.
+        n_frames -- Integer with the number of frames.
+        out_file -- String with path to a .npy file to hold the table as a
+                    memory mapped array (for very long series) or None
+                    (default) to keep it in memory.
+
+    Return:
+        light_curve -- 2D numpy array (n_stars, 3 + 2*n_frames).
+    """
+
+    shape = (n_stars, 3 + 2*n_frames)
+
+    if out_file is None:
+        return np.full(shape, np.nan)
+
+    light_curve = np.lib.format.open_memmap(out_file, mode="w+",
+                                            dtype=np.float64, shape=shape)
+    light_curve[:] = np.nan
+
+    return light_curve
 
 
 def assemble_lightcurve(
         image_folder,
         catalog,
         pars_ds,
-        aperture_factors={"r": 2, "r_in": 2.5, "r_out": 3.5}):
+        aperture_factors={"r": 2, "r_in": 2.5, "r_out": 3.5},
+        transforms=None,
+        out_file=None,
+        n_jobs=1,
+        fwhm_step=None,
+        cutouts=False,
+        recenter=False,
+        store_path=None):
     """
     Apply get photometry iteravively in all images of a folder to create a
     light curve table.
@@ -118,40 +505,215 @@ def assemble_lightcurve(
         pars_ds -- String with path to parameters file.
         aperture_factors -- Dict with factors to scale apertures in units of
                             FWHM.
+        transforms -- String with path to the transforms file created with
+                      pre_processing.alignment.align_all_images(resample=False)
+                      or None (default) when the images are already aligned.
+                      When given, the catalog positions are mapped into each
+                      image and the X, Y columns keep the catalog positions.
+        out_file -- String with path to a .npy file where the table is built
+                    as a memory mapped array (see allocate_lightcurve) or
+                    None (default) to build it in memory.
+        n_jobs -- Integer with the number of processes. With more than one
+                  the frames are distributed over a process pool (catalog,
+                  parameters and transforms are sent once per worker) and
+                  the results are gathered in frame order.
+        fwhm_step -- Float with a FWHM bucket width in pixels or None
+                     (default). When given (only for aligned images, without
+                     transforms) the apertures use the FWHM rounded to a
+                     multiple of it and are precomputed as sparse matrices
+                     once per bucket (see iraf_phot.ApertureMatrix).
+        cutouts -- Boolean, if True read only the boxes around the stars of
+                   each frame (see measure_frame).
+        recenter -- Boolean, if True the positions are refined on each frame
+                    (see recenter_positions) before the photometry and
+                    returned next to the table.
+        store_path -- String with path to a folder where the light curves
+                      are also written in long format (see
+                      lightcurve_store.write_store, jd and airmass come from
+                      the parameters file) or None (default).
 
     Return:
         light_curve -- 2D numpy array with table of light curve.
+        centers -- Only if recenter is True. 2D numpy array (stars,
+                   2*frames) with the refined x, y of each frame, in the
+                   order of the magnitude, error columns of light_curve.
+                   With out_file it is also saved as <out_file>_xy.npy.
 
     """
 
     pars = pd.read_csv(pars_ds, index_col="file")
 
+    if out_file is not None:
+        out_file = os.path.abspath(out_file)
+
+    if fwhm_step is not None and (transforms is not None or recenter):
+        raise ValueError("fwhm_step needs fixed positions (transforms=None, recenter=False)")
+
+    if transforms is not None:
+        transforms = pd.read_csv(transforms, index_col="file")
+
     with indir(image_folder):
 
         images = glob("*.fits")
         images.sort()
 
+        if transforms is not None:
+            missing = [im for im in images if im not in transforms.index]
+            images = [im for im in images if im in transforms.index]
+            if missing:
+                print(f"Skipping {len(missing)} images without transform: {missing}")
 
-        print(f"Starting to assemble time series table of images on {image_folder}")
 
+        print(f"Starting to assemble time series table of images on {image_folder}")
 
-        light_curve = get_photometry(images[0],
-                                     catalog,
-                                     pars.loc[images[0]],
-                                     aperture_factors=aperture_factors,
-                                     first=True)
 
-        images = images[1:]
         N = len(images)
+        light_curve = allocate_lightcurve(len(catalog), N, out_file)
+
+        # Keep positions on the catalog reference
+        light_curve[:, :3] = catalog[:, :3]
+
+        if recenter:
+            centers = np.full((len(catalog), 2*N), np.nan)
+
+        state = {"catalog": catalog, "pars": pars, "transforms": transforms,
+                 "aperture_factors": aperture_factors, "fwhm_step": fwhm_step,
+                 "cutouts": cutouts, "recenter": recenter}
+        items = [(os.path.abspath(im),) for im in images]
+
+        def store(i, photometry):
+            light_curve[:, 3 + 2*i:5 + 2*i] = photometry[:, :2]
+
+            if recenter:
+                centers[:, 2*i:2*i + 2] = photometry[:, 2:]
 
-        for i, im in enumerate(images, start=1):
-            print(f"Doing photometry of {im} ... ({i} of {N})")
-            light_curve = np.hstack([light_curve,
-                                     get_photometry(im,
-                                                    catalog,
-                                                    pars.loc[im],
-                                                    aperture_factors=aperture_factors)])
+            print(f"Did photometry of {images[i]} ... ({i + 1} of {N})")
+
+        if n_jobs <= 1:
+            cache = {}
+            for i, item in enumerate(items):
+                store(i, _frame_photometry(*item, **state, cache=cache))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_init_photometry_worker,
+                                     initargs=(_frame_photometry, state)) as pool:
+                results = pool.map(_photometry_worker, items,
+                                   chunksize=max(1, N // (4*n_jobs)))
+                for i, photometry in enumerate(results):
+                    store(i, photometry)
+
+        if out_file is not None:
+            light_curve.flush()
+
+            if recenter:
+                np.save(os.path.splitext(out_file)[0] + "_xy.npy", centers)
 
         print("Finished Photometry.")
 
+    if store_path is not None:
+        frame_pars = pars.loc[images]
+        write_store(store_path, light_curve,
+                    jd=frame_pars["jd"] if "jd" in frame_pars else np.full(N, np.nan),
+                    airmass=frame_pars["airmass"] if "airmass" in frame_pars else None,
+                    centers=centers if recenter else None,
+                    frames=images)
+
+    if recenter:
+        return light_curve, centers
+
     return light_curve
+
+
+def curve_of_growth(
+        image_folder,
+        catalog,
+        pars_ds,
+        aperture_factors={"r": [1.0, 1.5, 2.0, 2.5, 3.0], "r_in": 3.5, "r_out": 4.5},
+        zero_point=25,
+        fwhm_step=None,
+        n_jobs=1,
+        cutouts=False):
+    """
+    Photometry of the aligned images of a folder with several aperture radii
+    at once: each image is read once and its sky annulus estimated once for
+    all the radii.
+
+    Args:
+        image_folder -- String with path to folder with the images.
+        catalog -- 2D numpy array with table created with get_catalog.
+        pars_ds -- String with path to parameters file.
+        aperture_factors -- Dict with a list of factors ("r") and the
+                            annulus factors to scale apertures in units of
+                            FWHM.
+        zero_point -- Integer used as default zero point for the photometry.
+        fwhm_step -- Float with a FWHM bucket width in pixels or None (see
+                     assemble_lightcurve).
+        n_jobs -- Integer with the number of processes.
+        cutouts -- Boolean, if True read only the boxes around the stars of
+                   each frame (see measure_frame).
+
+    Return:
+        mags -- 3D numpy array (stars, radii, frames) with magnitudes.
+        errors -- 3D numpy array (stars, radii, frames) with the errors.
+        images -- List with the names of the images (frames order).
+    """
+
+    pars = pd.read_csv(pars_ds, index_col="file")
+
+    with indir(image_folder):
+
+        images = glob("*.fits")
+        images.sort()
+
+        N = len(images)
+        n_radii = len(aperture_factors["r"])
+        mags = np.full((len(catalog), n_radii, N), np.nan)
+        errors = np.full((len(catalog), n_radii, N), np.nan)
+
+        state = {"catalog": catalog, "pars": pars, "aperture_factors": aperture_factors,
+                 "fwhm_step": fwhm_step, "zero_point": zero_point, "cutouts": cutouts}
+        items = [(os.path.abspath(im),) for im in images]
+
+        def store(i, photometry):
+            mags[:, :, i], errors[:, :, i] = photometry
+            print(f"Did photometry of {images[i]} ... ({i + 1} of {N})")
+
+        if n_jobs <= 1:
+            cache = {}
+            for i, item in enumerate(items):
+                store(i, _frame_growth(*item, **state, cache=cache))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_init_photometry_worker,
+                                     initargs=(_frame_growth, state)) as pool:
+                results = pool.map(_photometry_worker, items,
+                                   chunksize=max(1, N // (4*n_jobs)))
+                for i, photometry in enumerate(results):
+                    store(i, photometry)
+
+        print("Finished Photometry.")
+
+    return mags, errors, images
+
+
+def best_aperture(mags, errors):
+    """
+    Pick for each star the radius of a curve of growth with the smallest
+    median error along the series.
+
+    Args:
+        mags -- 3D numpy array (stars, radii, frames) from curve_of_growth.
+        errors -- 3D numpy array (stars, radii, frames) from curve_of_growth.
+
+    Return:
+        mags -- 2D numpy array (stars, frames) with the chosen magnitudes.
+        errors -- 2D numpy array (stars, frames) with the chosen errors.
+        best -- 1D numpy array with the index of the radius of each star.
+    """
+
+    median_error = np.nanmedian(np.where(np.isfinite(errors), errors, np.nan), axis=2)
+    best = np.argmin(np.where(np.isnan(median_error), np.inf, median_error), axis=1)
+
+    stars = np.arange(len(mags))
+
+    return mags[stars, best], errors[stars, best], best
@@ -5,6 +5,8 @@ generated with the aperture_photometry module.
 import numpy as np
 import matplotlib.pyplot as plt
 
+from wdpipe.photometry.lightcurve_store import LightCurveStore
+
 
 def convert_to_flux(x):
     """Covert value (x) from magnitude to flux"""
@@ -16,6 +18,38 @@ def convert_to_magnitude(x):
     return -2.512*np.log10(x)
 
 
+def load_time_series(store_path, stars=None, region=None, jd_range=None):
+    """
+    Read from a light curve store (see lightcurve_store) only the stars and
+    epochs needed, in the layout used by the functions of this module.
+
+    Parameters
+    -----------
+        store_path : str
+            Path to the store folder.
+
+        stars : list of int or None, default=None
+            IDs of the stars to read, all if None.
+
+        region : tuple or None, default=None
+            Box (xmin, xmax, ymin, ymax) on the positions.
+
+        jd_range : tuple or None, default=None
+            Interval (start, end) of julian dates.
+
+    Returns
+    -------
+        time_series : np.ndarray
+            Light curves with the layout of assemble_lightcurve.
+
+        jd : np.ndarray
+            1d array with the julian date of each point of the light curves.
+    """
+
+    return LightCurveStore(store_path).time_series(stars=stars, region=region,
+                                                   jd_range=jd_range)
+
+
 def calc_ref_magnitude(time_series, n=10):
     """
     From time series table (generated with assemble_lightcurve) get the `n`
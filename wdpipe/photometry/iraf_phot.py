@@ -0,0 +1,270 @@
+"""
+Vectorized IRAF style aperture photometry for a fixed catalog.
+
+The apertures and sky annuli of all stars are turned once into a sparse
+(stars x pixels) weight matrix and a table of annulus pixel indices, so the
+photometry of each frame is one sparse mat-vec for the aperture sums plus a
+gather of the annulus pixels for the sky statistics. Only the pixels used
+by the apertures are needed, so frames can be measured reading just the
+boxes around the stars.
+"""
+import warnings
+
+import numpy as np
+from scipy import sparse
+from photutils.aperture import CircularAperture, CircularAnnulus
+
+
+def _mask_pixels(aperture, shape):
+    """
+    Flat pixel indices and exact overlap weights of each mask of a photutils
+    aperture inside an image of the given shape.
+    (aperture, tuple -> list of (indices, weights))
+    """
+    nx = shape[1]
+    pixels = []
+
+    for mask in aperture.to_mask(method="exact"):
+        slices = mask.get_overlap_slices(shape)
+
+        if slices[0] is None:
+            pixels.append((np.empty(0, dtype=np.intp), np.empty(0)))
+            continue
+
+        large, small = slices
+        weights = mask.data[small]
+        yy, xx = np.nonzero(weights)
+
+        indices = (yy + large[0].start)*nx + xx + large[1].start
+        pixels.append((indices, weights[yy, xx]))
+
+    return pixels
+
+
+def clipped_sky_stats(values, low=3, high=3):
+    """
+    Sky statistics of many sets of pixels at once, after an iterative
+    sigma clipping around the mean until no pixel is rejected (as
+    scipy.stats.sigmaclip).
+
+    Args:
+        values -- 2D numpy array (sets, pixels) padded with NaN.
+        low, high -- Floats with the clipping thresholds in standard
+                     deviations.
+
+    Return:
+        Dict of 1D numpy arrays: mean, median, mode (3*median - 2*mean), std
+        and area (number of pixels left).
+    """
+    values = np.array(values, dtype=np.float64)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        while True:
+            valid = ~np.isnan(values)
+            area = valid.sum(axis=1)
+            mean = np.where(valid, values, 0).sum(axis=1)/area
+            dev = np.where(valid, values - mean[:, None], 0)
+            std = np.sqrt((dev**2).sum(axis=1)/area)
+
+            out = ((values < (mean - low*std)[:, None])
+                   | (values > (mean + high*std)[:, None]))
+
+            if not out.any():
+                break
+
+            values[out] = np.nan
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(values, axis=1)
+
+    return {"mean": mean, "median": median, "mode": 3*median - 2*mean,
+            "std": std, "area": area}
+
+
+def iraf_errors(flux_variance, ap_area, sky_std, sky_area, epadu=1.0):
+    """
+    IRAF (phot) flux errors: photon noise, sky noise on the aperture and the
+    error on the mean sky.
+
+    Args:
+        flux_variance -- Numpy array with the variance of the flux (the flux
+                         itself when no error array is used).
+        ap_area -- Float or array with the aperture area.
+        sky_std -- Numpy array with the standard deviation of the sky.
+        sky_area -- Numpy array with the number of sky pixels.
+        epadu -- Float with the gain in electrons per ADU.
+
+    Return:
+        Numpy array with the flux errors.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        variance = (flux_variance/epadu + ap_area*sky_std**2
+                    + ap_area**2*sky_std**2/sky_area)
+
+        return np.sqrt(variance)
+
+
+class ApertureMatrix:
+    """
+    Circular apertures and sky annuli of a fixed catalog on images of a
+    given shape, kept as a sparse weight matrix (exact pixel overlaps, as
+    photutils.aperture_photometry) and a padded table of annulus pixels
+    (pixels with any overlap, as the IRAF style sky statistics).
+
+    With a sequence of aperture radii (curve of growth) the weights of all
+    radii are stacked on the same matrix, the sky is estimated once per star
+    and the results get one column per radius.
+
+    Args:
+        positions -- 2D numpy array with x, y columns.
+        shape -- Tuple with the (ny, nx) shape of the images.
+        r -- Float or sequence of floats with the aperture radii.
+        r_in, r_out -- Floats with the annulus radii.
+    """
+
+    def __init__(self, positions, shape, r, r_in, r_out):
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.shape = tuple(shape)
+        self.radii = np.atleast_1d(np.asarray(r, dtype=np.float64))
+        self.multiple = np.ndim(r) > 0
+        self.area = np.pi*self.radii**2 if self.multiple else np.pi*r**2
+
+        n_stars = len(self.positions)
+        n_pixels = self.shape[0]*self.shape[1]
+
+        aperture = [pixels for radius in self.radii for pixels in
+                    _mask_pixels(CircularAperture(self.positions, r=radius), self.shape)]
+        rows = np.repeat(np.arange(len(aperture)), [len(indices) for indices, _ in aperture])
+        self.weights = sparse.csr_matrix(
+                (np.concatenate([weights for _, weights in aperture]),
+                 (rows, np.concatenate([indices for indices, _ in aperture]))),
+                shape=(len(aperture), n_pixels))
+
+        annulus = _mask_pixels(CircularAnnulus(self.positions, r_in=r_in, r_out=r_out),
+                               self.shape)
+        size = max([len(indices) for indices, _ in annulus], default=0)
+        self.annulus = np.zeros((n_stars, size), dtype=np.intp)
+        self.annulus_valid = np.zeros((n_stars, size), dtype=bool)
+
+        for i, (indices, _) in enumerate(annulus):
+            self.annulus[i, :len(indices)] = indices
+            self.annulus_valid[i, :len(indices)] = True
+
+        #  Compact pixel space: only the pixels used by some aperture or
+        #  annulus, with the bounding box of the pixels of each star
+        self.pixels = np.union1d(self.weights.indices, self.annulus[self.annulus_valid])
+        self._weights = self.weights[:, self.pixels]
+        self._annulus = np.searchsorted(self.pixels, self.annulus)
+
+        self.boxes = np.zeros((n_stars, 4), dtype=int)
+        self._box_pixels = []
+        for i in range(n_stars):
+            own = [indices for indices, _ in aperture[i::n_stars]] + [annulus[i][0]]
+            own = np.unique(np.concatenate(own))
+
+            if len(own) == 0:
+                self._box_pixels.append((own, own))
+                continue
+
+            y, x = np.divmod(own, self.shape[1])
+            y0, x0 = y.min(), x.min()
+            self.boxes[i] = y0, y.max() + 1, x0, x.max() + 1
+
+            width = self.boxes[i, 3] - x0
+            self._box_pixels.append((np.searchsorted(self.pixels, own),
+                                     (y - y0)*width + x - x0))
+
+    def sums(self, data):
+        """
+        Aperture sums of all stars on an image (ny, nx) or on a stack of
+        images (frames, ny, nx), giving (stars,) or (stars, frames), with a
+        radius axis after the stars axis for multiple radii.
+        """
+        data = np.asarray(data, dtype=np.float64)
+
+        if data.ndim == 2:
+            sums = self.weights @ data.ravel()
+        else:
+            sums = self.weights @ data.reshape(len(data), -1).T
+
+        if not self.multiple:
+            return sums
+
+        sums = sums.reshape((len(self.radii), len(self.positions)) + sums.shape[1:])
+
+        return np.moveaxis(sums, 0, 1)
+
+    def gather(self, data):
+        """Values (float64) of the used pixels (self.pixels) of an image."""
+        return np.ravel(data)[self.pixels].astype(np.float64)
+
+    def read_pixels(self, section):
+        """
+        Values of the used pixels (self.pixels) reading only the bounding box
+        of each star from `section`, any object accepting 2D slices as an
+        image (e.g. the `section` of a FITS HDU or a memory mapped array).
+        """
+        values = np.empty(len(self.pixels))
+
+        for (y0, y1, x0, x1), (targets, local) in zip(self.boxes, self._box_pixels):
+            if len(targets):
+                values[targets] = np.ravel(section[y0:y1, x0:x1])[local]
+
+        return values
+
+    def sky_pixels(self, data):
+        """Annulus pixels of each star (stars, pixels) padded with NaN."""
+        return self._sky_pixels(self.gather(data))
+
+    def _sky_pixels(self, values):
+        """Annulus pixels from the used pixel values, padded with NaN."""
+        sky = values[self._annulus]
+        sky[~self.annulus_valid] = np.nan
+
+        return sky
+
+    def photometry(self, data, epadu=1.0, bg_method="mode"):
+        """
+        IRAF style photometry of all stars on an image.
+
+        Args:
+            data -- 2D numpy array with the image.
+            epadu -- Float with the gain in electrons per ADU.
+            bg_method -- String with the sky estimator: "mean", "median" or
+                         "mode".
+
+        Return:
+            Dict of numpy arrays: X, Y, flux, flux_error, mag, mag_error and
+            sky (magnitudes without zero point). With multiple radii flux,
+            mag and their errors are (stars, radii).
+        """
+        return self.photometry_pixels(self.gather(data), epadu=epadu, bg_method=bg_method)
+
+    def photometry_pixels(self, values, epadu=1.0, bg_method="mode"):
+        """
+        Same as photometry but from the values of the used pixels (from
+        gather or read_pixels).
+        """
+        if bg_method not in ("mean", "median", "mode"):
+            raise ValueError("Invalid background method, choose either mean, median, or mode")
+
+        sky = clipped_sky_stats(self._sky_pixels(values))
+
+        if self.multiple:
+            sky = {key: value[:, None] for key, value in sky.items()}
+
+        sums = self._weights @ values
+        if self.multiple:
+            sums = sums.reshape(len(self.radii), len(self.positions)).T
+
+        flux = sums - sky[bg_method]*self.area
+        flux_error = iraf_errors(flux, self.area, sky["std"], sky["area"], epadu)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mag = -2.5*np.log10(flux)
+            mag_error = 1.0857*flux_error/flux
+
+        return {"X": self.positions[:, 0], "Y": self.positions[:, 1],
+                "flux": flux, "flux_error": flux_error,
+                "mag": mag, "mag_error": mag_error, "sky": np.ravel(sky[bg_method])}
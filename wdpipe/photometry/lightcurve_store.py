@@ -0,0 +1,258 @@
+"""
+Long format (one row per star and frame) columnar store of light curves.
+
+The store is a folder with a `manifest.json` and one subfolder per chunk
+holding a .npy file per column (star_id, frame, jd, airmass, mag, err, x,
+y). Chunks are blocks of stars by blocks of frames and the manifest keeps
+the minimum and maximum of star_id, jd, x and y of each chunk, so queries by
+star, sky region or time range only open the chunks (and, memory mapped,
+only the columns) they need.
+"""
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+
+#  Columns of the store and their types
+COLUMNS = {"star_id": "int64",
+           "frame": "int32",
+           "jd": "float64",
+           "airmass": "float64",
+           "mag": "float64",
+           "err": "float64",
+           "x": "float64",
+           "y": "float64"}
+
+#  Columns with minimum and maximum on the manifest
+INDEXED = ["star_id", "jd", "x", "y"]
+
+MANIFEST = "manifest.json"
+
+
+def write_store(path, light_curve, jd, airmass=None, centers=None, frames=None,
+                star_chunk=256, frame_chunk=256):
+    """
+    Write a light curve table (from photometry.aperture_phot
+    assemble_lightcurve) as a long format columnar store.
+
+    Args:
+        path -- String with path to the store folder (created).
+        light_curve -- 2D numpy array (stars, 3 + 2*frames) with ID, X, Y and
+                       magnitude, error pairs.
+        jd -- List with the julian date of each frame.
+        airmass -- List with the airmass of each frame or None.
+        centers -- 2D numpy array (stars, 2*frames) with the x, y of each
+                   frame (from assemble_lightcurve(recenter=True)) or None to
+                   use the X, Y columns of light_curve.
+        frames -- List with the names of the frames or None.
+        star_chunk, frame_chunk -- Integers with the number of stars and of
+                                   frames of each chunk.
+
+    Return:
+        LightCurveStore.
+    """
+
+    n_stars = light_curve.shape[0]
+    n_frames = (light_curve.shape[1] - 3)//2
+
+    jd = np.asarray(jd, dtype=np.float64)
+    airmass = (np.full(n_frames, np.nan) if airmass is None
+               else np.asarray(airmass, dtype=np.float64))
+
+    if len(jd) != n_frames or len(airmass) != n_frames:
+        raise ValueError(f"Expected {n_frames} frames on jd and airmass")
+
+    os.makedirs(path, exist_ok=True)
+    chunks = []
+
+    for s0 in range(0, n_stars, star_chunk):
+        stars = slice(s0, min(s0 + star_chunk, n_stars))
+        block = np.asarray(light_curve[stars])
+
+        for f0 in range(0, n_frames, frame_chunk):
+            frame = np.arange(f0, min(f0 + frame_chunk, n_frames))
+
+            if centers is None:
+                x = np.repeat(block[:, 1], len(frame))
+                y = np.repeat(block[:, 2], len(frame))
+            else:
+                x = np.asarray(centers[stars, 2*frame]).ravel()
+                y = np.asarray(centers[stars, 2*frame + 1]).ravel()
+
+            columns = {"star_id": np.repeat(block[:, 0], len(frame)),
+                       "frame": np.tile(frame, len(block)),
+                       "jd": np.tile(jd[frame], len(block)),
+                       "airmass": np.tile(airmass[frame], len(block)),
+                       "mag": block[:, 3 + 2*frame].ravel(),
+                       "err": block[:, 4 + 2*frame].ravel(),
+                       "x": x,
+                       "y": y}
+
+            name = f"chunk_{len(chunks):05d}"
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+
+            for column, dtype in COLUMNS.items():
+                np.save(os.path.join(path, name, f"{column}.npy"),
+                        columns[column].astype(dtype))
+
+            chunks.append({"name": name,
+                           "rows": len(columns["star_id"]),
+                           "min": {c: float(np.nanmin(columns[c])) for c in INDEXED},
+                           "max": {c: float(np.nanmax(columns[c])) for c in INDEXED}})
+
+    manifest = {"columns": COLUMNS,
+                "n_stars": n_stars,
+                "n_frames": n_frames,
+                "frames": list(frames) if frames is not None else None,
+                "chunks": chunks}
+
+    with open(os.path.join(path, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    return LightCurveStore(path)
+
+
+class LightCurveStore:
+    """
+    Reader of a store written with write_store.
+
+    Args:
+        path -- String with path to the store folder.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+
+        self.chunks = self.manifest["chunks"]
+        self.n_stars = self.manifest["n_stars"]
+        self.n_frames = self.manifest["n_frames"]
+        self.frames = self.manifest["frames"]
+
+    def _column(self, chunk, column):
+        """Memory mapped column of a chunk"""
+        return np.load(os.path.join(self.path, chunk["name"], f"{column}.npy"), mmap_mode="r")
+
+    def _chunk_may_match(self, chunk, stars, region, jd_range):
+        """Check the chunk minimum and maximum against the predicates"""
+        low, high = chunk["min"], chunk["max"]
+
+        if stars is not None:
+            first = np.searchsorted(stars, low["star_id"])
+            if first == len(stars) or stars[first] > high["star_id"]:
+                return False
+
+        if region is not None:
+            xmin, xmax, ymin, ymax = region
+            if high["x"] < xmin or low["x"] > xmax or high["y"] < ymin or low["y"] > ymax:
+                return False
+
+        if jd_range is not None:
+            if high["jd"] < jd_range[0] or low["jd"] > jd_range[1]:
+                return False
+
+        return True
+
+    def query(self, columns=None, stars=None, region=None, jd_range=None):
+        """
+        Rows of the store matching all the given predicates. Chunks that
+        can't match are skipped and only the needed columns are read.
+
+        Args:
+            columns -- List with the columns to return or None for all.
+            stars -- List with the star ids or None.
+            region -- Tuple (xmin, xmax, ymin, ymax) with a box on the
+                      positions or None.
+            jd_range -- Tuple (start, end) with the julian dates or None.
+
+        Return:
+            Pandas DataFrame with the rows (ordered by chunk, star, frame).
+        """
+
+        columns = list(COLUMNS) if columns is None else list(columns)
+        if stars is not None:
+            stars = np.unique(np.asarray(stars, dtype=np.int64))
+
+        filters = (["star_id"] if stars is not None else []) \
+            + (["x", "y"] if region is not None else []) \
+            + (["jd"] if jd_range is not None else [])
+
+        parts = []
+        for chunk in self.chunks:
+            if not self._chunk_may_match(chunk, stars, region, jd_range):
+                continue
+
+            keep = np.ones(chunk["rows"], dtype=bool)
+            loaded = {}
+
+            for column in filters:
+                loaded[column] = self._column(chunk, column)
+
+            if stars is not None:
+                keep &= np.isin(loaded["star_id"], stars)
+
+            if region is not None:
+                xmin, xmax, ymin, ymax = region
+                keep &= ((loaded["x"] >= xmin) & (loaded["x"] <= xmax)
+                         & (loaded["y"] >= ymin) & (loaded["y"] <= ymax))
+
+            if jd_range is not None:
+                keep &= (loaded["jd"] >= jd_range[0]) & (loaded["jd"] <= jd_range[1])
+
+            if not keep.any():
+                continue
+
+            rows = np.flatnonzero(keep)
+            parts.append(pd.DataFrame({column: (loaded[column] if column in loaded
+                                                else self._column(chunk, column))[rows]
+                                       for column in columns}))
+
+        if not parts:
+            return pd.DataFrame({column: np.empty(0, dtype=COLUMNS[column]) for column in columns})
+
+        return pd.concat(parts, ignore_index=True)
+
+    def time_series(self, stars=None, region=None, jd_range=None):
+        """
+        Matching rows in the wide layout of assemble_lightcurve (ID, X, Y and
+        magnitude, error pairs), as used by differential_phot.
+
+        Args:
+            stars, region, jd_range -- Predicates as on query.
+
+        Return:
+            time_series -- 2D numpy array (stars, 3 + 2*frames). X, Y are the
+                           first available positions of each star on the
+                           selected frames.
+            jd -- 1D numpy array with the julian date of each frame.
+        """
+
+        rows = self.query(columns=["star_id", "frame", "jd", "mag", "err", "x", "y"],
+                          stars=stars, region=region, jd_range=jd_range)
+
+        ids, star_index = np.unique(rows["star_id"].to_numpy(), return_inverse=True)
+        frames, frame_index = np.unique(rows["frame"].to_numpy(), return_inverse=True)
+
+        time_series = np.full((len(ids), 3 + 2*len(frames)), np.nan)
+        time_series[:, 0] = ids
+        time_series[star_index, 3 + 2*frame_index] = rows["mag"].to_numpy()
+        time_series[star_index, 4 + 2*frame_index] = rows["err"].to_numpy()
+
+        #  Earliest frame with a position of each star
+        x, y = rows["x"].to_numpy(), rows["y"].to_numpy()
+        valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        valid = valid[np.lexsort((frame_index[valid], star_index[valid]))]
+        _, first = np.unique(star_index[valid], return_index=True)
+        first = valid[first]
+
+        time_series[star_index[first], 1] = x[first]
+        time_series[star_index[first], 2] = y[first]
+
+        jd = np.full(len(frames), np.nan)
+        jd[frame_index] = rows["jd"].to_numpy()
+
+        return time_series, jd
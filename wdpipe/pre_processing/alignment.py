@@ -3,15 +3,114 @@
 This module contains functions to help align images.
 """
 import numpy as np
+import pandas as pd
 import astroalign
 from astropy.io import fits
 from glob import glob
+from functools import lru_cache
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from skimage.transform import SimilarityTransform
 from skimage.util import img_as_float64
 from ..utils.context_managers import indir
+from ..utils.fits_io import load_frame
 
 
-def align_with(image, ref_matrix, ref_file, max_control_points=50, min_area=5):
+def reference_control_points(ref_matrix, max_control_points=50, detection_sigma=5, min_area=5):
+    """
+    Detect the control points (stars) of a reference image the same way
+    astroalign does, so they can be computed once and reused to align a batch
+    of images.
+
+    Parameters
+    ----------
+        ref_matrix : Numpy 2D array
+            Reference image.
+        max_control_points : int
+            Maximum number of control points to keep (brightest first).
+        detection_sigma : int
+            Factor of background std-dev above which is considered a detection.
+        min_area : int
+            Minimum number of connected pixels to be considered a source.
+
+    Returns
+    -------
+        ref_points : Numpy 2D array
+            (N, 2) array with the x, y positions of the control points.
+    """
+    return astroalign._find_sources(
+            astroalign._bw(ref_matrix),
+            detection_sigma=detection_sigma,
+            min_area=min_area
+            )[:max_control_points]
+
+
+def solve_transform(data, ref_points, max_control_points=50, min_area=5):
+    """
+    Find the similarity transform that maps pixel positions (x, y) of an image
+    into the reference, given the reference control points.
+
+    Parameters
+    ----------
+        data : Numpy 2D array
+            Image to align.
+        ref_points : Numpy 2D array
+            Control points of the reference computed with
+            reference_control_points.
+
+    Returns
+    -------
+        transform : skimage.transform.SimilarityTransform
+            Transform from image to reference pixel positions.
+    """
+    transform, _ = astroalign.find_transform(
+            data,
+            ref_points,
+            max_control_points=max_control_points,
+            min_area=min_area
+            )
+
+    return transform
+
+
+def transform_with(image, ref_points, ref_file, max_control_points=50, min_area=5):
+    """
+    Given a FITS file solve its transform to the reference without resampling
+    the image. The file is not modified.
+
+    Parameters
+    ----------
+        image : str
+            Path to image to align with the reference.
+        ref_points : Numpy 2D array
+            Control points of the reference computed with
+            reference_control_points.
+        ref_file : str
+            Name of reference FITS file.
+
+    Returns
+    -------
+        row : dict
+            File name, reference file name and the transform parameters
+            (scale, rotation in radians and translation tx, ty in pixels)
+            mapping image positions into reference positions.
+    """
+    data, _ = load_frame(image)
+    data = img_as_float64(data)
+
+    transform = solve_transform(data, ref_points,
+                                max_control_points=max_control_points,
+                                min_area=min_area)
+
+    return {"file": image,
+            "ref_file": ref_file,
+            "scale": transform.scale,
+            "rotation": transform.rotation,
+            "tx": transform.translation[0],
+            "ty": transform.translation[1]}
+
+
+def align_with(image, ref_matrix, ref_file, max_control_points=50, min_area=5, ref_points=None):
     """
     Given a FITS file it will open the file and align to the reference image
     matrix and rewrite the file.
@@ -31,6 +130,10 @@ def align_with(image, ref_matrix, ref_file, max_control_points=50, min_area=5):
             Reference image.
         ref_name : str
             Name of reference FITS file.
+        ref_points : Numpy 2D array or None
+            Control points of the reference computed with
+            reference_control_points. If None they are detected on the
+            ref_matrix at each call.
 
     Returns
     -------
@@ -41,21 +144,27 @@ def align_with(image, ref_matrix, ref_file, max_control_points=50, min_area=5):
     """
     # Loading
 
-    data = fits.getdata(image)
+    data, header = load_frame(image)
     data = img_as_float64(data)  # Converting to float to avoid scikitimage bug
                                  # Issue #4525
 
-    header = fits.getheader(image)
     new_image = "a_" + image
 
     # Aligning
 
-    aligned_image, _ = astroalign.register(
-            data,
-            ref_matrix, 
-            max_control_points=max_control_points,
-            min_area=min_area
-            )
+    if ref_points is None:
+        aligned_image, _ = astroalign.register(
+                data,
+                ref_matrix, 
+                max_control_points=max_control_points,
+                min_area=min_area
+                )
+    else:
+        # Same as register, but matching against the precomputed reference
+        transform = solve_transform(data, ref_points,
+                                    max_control_points=max_control_points,
+                                    min_area=min_area)
+        aligned_image, _ = astroalign.apply_transform(transform, data, ref_matrix)
 
     # Re-write file and update header
 
@@ -66,17 +175,455 @@ def align_with(image, ref_matrix, ref_file, max_control_points=50, min_area=5):
     os.remove(image)
 
 
+@lru_cache(maxsize=1)
+def _reference_spectrum(ref_path):
+    """
+    Real FFT of the reference image minus its median, computed once per
+    process (cleared at the end of align_all_images)
+    """
+    ref = img_as_float64(fits.getdata(ref_path))
+    return np.fft.rfft2(ref - np.median(ref))
+
+
+def phase_correlation(spectrum, ref_spectrum, shape):
+    """
+    Estimate the translation between an image and the reference by phase
+    correlation, with sub-pixel precision from a Gaussian (log-parabolic) fit
+    around the correlation peak.
+
+    The cross power spectrum is only partially whitened (divided by the
+    square root of its modulus): full whitening amplifies the noise at high
+    frequencies and gives a sharp peak that is poorly described by the fit.
+
+    Parameters
+    ----------
+        spectrum : Numpy 2D array
+            Real FFT (np.fft.rfft2) of the image minus its median.
+        ref_spectrum : Numpy 2D array
+            Real FFT of the reference image minus its median.
+        shape : tuple of int
+            Shape of the images.
+
+    Returns
+    -------
+        shift : Numpy 1D array
+            Shift (dy, dx) such that image(y, x) = reference(y - dy, x - dx).
+    """
+    cross = spectrum * np.conj(ref_spectrum)
+    cross /= np.sqrt(np.abs(cross)) + np.finfo(np.float64).tiny
+    corr = np.fft.irfft2(cross, s=shape)
+
+    peak = np.unravel_index(np.argmax(corr), shape)
+
+    shift = np.zeros(2)
+    for axis, n in enumerate(shape):
+        before, after = list(peak), list(peak)
+        before[axis] = (peak[axis] - 1) % n
+        after[axis] = (peak[axis] + 1) % n
+
+        c0, cb, ca = corr[peak], corr[tuple(before)], corr[tuple(after)]
+        if min(cb, ca) > 0:
+            c0, cb, ca = np.log(c0), np.log(cb), np.log(ca)
+
+        denominator = cb - 2*c0 + ca
+        delta = 0.5*(cb - ca)/denominator if denominator != 0 else 0
+
+        shift[axis] = peak[axis] + delta
+        if shift[axis] > n/2:
+            shift[axis] -= n
+
+    return shift
+
+
+def translation_residuals(data, ref_points, shift, n_stars=10, radius=5, nsigma=5):
+    """
+    Check a translation on the brightest reference stars: predict their
+    position on the image, measure the centroid (first moments over a
+    background subtracted stamp) and return the distances between both.
+    Stars whose peak isn't `nsigma` above the noise of the stamp border are
+    skipped, so a shift landing on empty sky isn't validated.
+
+    Parameters
+    ----------
+        data : Numpy 2D array
+            Image.
+        ref_points : Numpy 2D array
+            Control points (x, y) of the reference, brightest first.
+        shift : sequence of float
+            Shift (dy, dx) from phase_correlation.
+        n_stars : int
+            Number of stars to check.
+        radius : int
+            Half size of the stamps.
+        nsigma : float
+            Detection threshold in units of the stamp border standard
+            deviation.
+
+    Returns
+    -------
+        residuals : Numpy 1D array
+            Distances in pixels (stars too close to the border are skipped).
+    """
+    dy, dx = shift
+    ny, nx = data.shape
+    offsets = np.arange(-radius, radius + 1)
+
+    residuals = []
+    for x, y in ref_points[:n_stars]:
+        px, py = x + dx, y + dy
+        xi, yi = int(round(px)), int(round(py))
+
+        if xi - radius < 0 or yi - radius < 0 or xi + radius >= nx or yi + radius >= ny:
+            continue
+
+        stamp = data[yi - radius:yi + radius + 1, xi - radius:xi + radius + 1]
+        border = np.concatenate([stamp[0], stamp[-1], stamp[1:-1, 0], stamp[1:-1, -1]])
+
+        if stamp.max() - np.median(border) < nsigma*border.std():
+            continue
+
+        stamp = np.clip(stamp - np.median(stamp), 0, None)
+        total = stamp.sum()
+
+        cx = xi + (stamp.sum(axis=0) @ offsets)/total
+        cy = yi + (stamp.sum(axis=1) @ offsets)/total
+        residuals.append(np.hypot(cx - px, cy - py))
+
+    return np.array(residuals)
+
+
+def shift_image(data, shift, mode="fourier"):
+    """
+    Shift an image so that it coincides with the reference, given the shift
+    from phase_correlation. The regions without information are filled with
+    the median of the image (as astroalign.apply_transform does): the
+    ceil(|shift|) rows and columns whose source falls outside the image.
+    For a sub-pixel "fourier" shift this includes the partial row or column
+    (e.g. one row for dy=0.4), whose values are mixed with the wrapped
+    border.
+
+    Parameters
+    ----------
+        data : Numpy 2D array
+            Image.
+        shift : sequence of float
+            Shift (dy, dx) from phase_correlation.
+        mode : str
+            "fourier" for a sub-pixel shift on the Fourier domain or
+            "integer" to shift by whole pixels (no interpolation).
+
+    Returns
+    -------
+        shifted : Numpy 2D array
+            Shifted image.
+    """
+    dy, dx = shift
+    ny, nx = data.shape
+
+    if mode == "integer":
+        dy, dx = np.round(shift)
+        shifted = np.roll(data, (-int(dy), -int(dx)), axis=(0, 1))
+    elif mode == "fourier":
+        spectrum = np.fft.rfft2(data)
+        ky = np.fft.fftfreq(ny)[:, None]
+        kx = np.fft.rfftfreq(nx)[None, :]
+        shifted = np.fft.irfft2(spectrum*np.exp(2j*np.pi*(ky*dy + kx*dx)), s=data.shape)
+    else:
+        raise ValueError(f"Unknown shift mode: {mode}")
+
+    # Fill the wrapped borders (dy, dx are whole pixels on "integer" mode)
+    fill = np.median(data)
+    iy, ix = int(np.ceil(abs(dy))), int(np.ceil(abs(dx)))
+
+    if dy > 0:
+        shifted[ny - iy:] = fill
+    elif dy < 0:
+        shifted[:iy] = fill
+
+    if dx > 0:
+        shifted[:, nx - ix:] = fill
+    elif dx < 0:
+        shifted[:, :ix] = fill
+
+    return shifted
+
+
+def solve_translation(data, ref_path, ref_points, max_residual=1.0):
+    """
+    Fast path for frames that are pure translations of the reference: estimate
+    the shift by phase correlation and verify it on the brightest reference
+    stars. Returns None when the shift doesn't explain the star positions
+    (e.g. when there is rotation), so the caller can fall back to astroalign.
+
+    Parameters
+    ----------
+        data : Numpy 2D array
+            Image.
+        ref_path : str
+            Path to the reference FITS file.
+        ref_points : Numpy 2D array
+            Control points of the reference computed with
+            reference_control_points.
+        max_residual : float
+            Maximum median residual in pixels to accept the shift.
+
+    Returns
+    -------
+        shift : Numpy 1D array or None
+            Shift (dy, dx) to use on shift_image.
+    """
+    ref_spectrum = _reference_spectrum(ref_path)
+    spectrum = np.fft.rfft2(data - np.median(data))
+
+    if spectrum.shape != ref_spectrum.shape:
+        return None
+
+    shift = phase_correlation(spectrum, ref_spectrum, data.shape)
+    residuals = translation_residuals(data, ref_points, shift)
+
+    if len(residuals) < 3 or np.median(residuals) > max_residual:
+        return None
+
+    return shift
+
+
+#  Attempts made by align_frame, each one overriding the alignment arguments.
+#  "downsample" bins the image by that factor before matching.
+FALLBACK_LADDER = (
+        {},
+        {"max_control_points": 100},
+        {"min_area": 10},
+        {"downsample": 2},
+        )
+
+
+def _step_parameters(step, max_control_points=50, min_area=5):
+    """(max_control_points, min_area) used by an attempt of the ladder"""
+    return (step.get("max_control_points", max_control_points),
+            step.get("min_area", min_area))
+
+
+def ladder_control_points(ref_matrix, ladder=FALLBACK_LADDER, max_control_points=50, min_area=5):
+    """
+    Reference control points for each detection setting used by a ladder,
+    so every attempt compares sources detected with the same parameters on
+    both images. Settings shared by several steps are detected only once.
+
+    Parameters
+    ----------
+        ref_matrix : Numpy 2D array
+            Reference image.
+        ladder : sequence of dicts
+            Attempts of align_frame. Default is FALLBACK_LADDER.
+        max_control_points, min_area : int
+            Base values, overridden by the steps of the ladder.
+
+    Returns
+    -------
+        ref_points : dict
+            Control points (as reference_control_points) keyed by
+            (max_control_points, min_area), including the base values.
+    """
+    ref_points = {}
+
+    for step in ({},) + tuple(ladder):
+        key = _step_parameters(step, max_control_points, min_area)
+
+        if key not in ref_points:
+            ref_points[key] = reference_control_points(ref_matrix,
+                                                       max_control_points=key[0],
+                                                       min_area=key[1])
+
+    return ref_points
+
+
+def _downsample(data, factor):
+    """Bin an image by an integer factor averaging blocks of pixels"""
+    ny, nx = (n // factor * factor for n in data.shape)
+    return data[:ny, :nx].reshape(ny // factor, factor, nx // factor, factor).mean(axis=(1, 3))
+
+
+def _solve_downsampled(data, ref_points, factor, max_control_points=50, min_area=5):
+    """
+    Solve the transform on a binned image and bring it back to the full
+    resolution pixel grid.
+    """
+    small = solve_transform(_downsample(data, factor),
+                            (ref_points - (factor - 1)/2)/factor,
+                            max_control_points=max_control_points,
+                            min_area=min_area)
+
+    c = (factor - 1)/2
+    down = np.array([[1/factor, 0, -c/factor], [0, 1/factor, -c/factor], [0, 0, 1]])
+    up = np.array([[factor, 0, c], [0, factor, c], [0, 0, 1]])
+
+    return SimilarityTransform(matrix=up @ small.params @ down)
+
+
+def align_frame(
+        image,
+        ref_shape,
+        ref_points,
+        ref_file,
+        resample=True,
+        max_control_points=50,
+        min_area=5,
+        ladder=FALLBACK_LADDER,
+        translation_first=False,
+        ref_path=None,
+        shift_mode="fourier"
+        ):
+    """
+    Solve (and optionally apply) the transform of a FITS file to the
+    reference, going through the steps of `ladder` until one succeeds. Errors
+    are caught and reported on the returned row, so one bad frame doesn't stop
+    a batch.
+
+    Parameters
+    ----------
+        image : str
+            Path to image to align with the reference.
+        ref_shape : tuple of int
+            Shape of the reference image.
+        ref_points : Numpy 2D array or dict
+            Control points of the reference computed with
+            ladder_control_points (one set per detection setting of the
+            ladder) or a single set from reference_control_points used by
+            every attempt.
+        ref_file : str
+            Name of reference FITS file.
+        resample : bool
+            If True write the aligned image as "a_" + name and remove the
+            original (as align_with). Default is True.
+        ladder : sequence of dicts
+            Attempts to make, each overriding max_control_points, min_area or
+            setting a downsample factor. Default is FALLBACK_LADDER.
+        translation_first : bool
+            If True try first the phase correlation fast path
+            (solve_translation) and only go to the ladder when it fails.
+            Default is False.
+        ref_path : str or None
+            Path to the reference FITS file, needed for translation_first.
+        shift_mode : str
+            How to apply the fast path shift: "fourier" or "integer".
+
+    Returns
+    -------
+        row : dict
+            File name, status ("ok" or "failed"), number of attempts, the
+            attempt that succeeded, last error, output file and transform
+            parameters (scale, rotation, tx, ty).
+
+    File transformation:
+        Write the aligned image and remove the original when resample is True.
+    """
+    row = {"file": os.path.basename(image), "status": "failed", "attempts": 0,
+           "step": None, "error": None, "out_file": None, "ref_file": ref_file}
+
+    try:
+        data, header = load_frame(image)
+        data = img_as_float64(data)
+    except Exception as error:
+        row["error"] = repr(error)
+        return row
+
+    def points_for(step):
+        if not isinstance(ref_points, dict):
+            return ref_points
+
+        return ref_points[_step_parameters(step, max_control_points, min_area)]
+
+    transform = None
+    shift = None
+
+    if translation_first and ref_path is not None:
+        row["attempts"] += 1
+        try:
+            shift = solve_translation(data, ref_path, points_for({}))
+        except Exception as error:
+            row["error"] = repr(error)
+
+    if shift is not None:
+        transform = SimilarityTransform(translation=(-shift[1], -shift[0]))
+        row["step"] = "translation"
+        ladder = ()
+
+    for step in ladder:
+        row["attempts"] += 1
+        points = points_for(step)
+        kwargs = dict(zip(("max_control_points", "min_area"),
+                          _step_parameters(step, max_control_points, min_area)))
+        try:
+            if step.get("downsample", 1) > 1:
+                transform = _solve_downsampled(data, points, step["downsample"], **kwargs)
+            else:
+                transform = solve_transform(data, points, **kwargs)
+            row["step"] = str(step)
+            break
+        except Exception as error:
+            row["error"] = repr(error)
+
+    if transform is None:
+        return row
+
+    row.update({"status": "ok",
+                "error": None,
+                "scale": transform.scale,
+                "rotation": transform.rotation,
+                "tx": transform.translation[0],
+                "ty": transform.translation[1]})
+
+    if not resample:
+        return row
+
+    try:
+        if shift is not None:
+            aligned_image = shift_image(data, shift, mode=shift_mode)
+        else:
+            # Only the shape of the target is used by apply_transform
+            aligned_image, _ = astroalign.apply_transform(transform, data,
+                                                          np.broadcast_to(np.float32(0), ref_shape))
+
+        header["ALIGNED-TO"] = ref_file
+
+        new_image = os.path.join(os.path.dirname(image), "a_" + os.path.basename(image))
+        fits.writeto(new_image, aligned_image.astype(np.float32), header)
+        os.remove(image)
+        row["out_file"] = os.path.basename(new_image)
+
+    except Exception as error:
+        row.update({"status": "failed", "error": repr(error)})
+
+    return row
+
+
 def align_all_images(
         images_folder,
         ref_file=None,
         max_control_points=50,
-        min_area=5
+        min_area=5,
+        resample=True,
+        transforms_name="transforms.csv",
+        n_jobs=1,
+        ladder=FALLBACK_LADDER,
+        log_name="alignment_log.csv",
+        translation_first=False,
+        shift_mode="fourier"
         ):
     """
     Align all FITS stellar images to reference file. If reference file is set
     to None it uses the first image in the folder.
 
-    # Wraps align_with function.
+    With `resample` False the images are left untouched and only the
+    transform of each image to the reference is solved and written in a
+    table, to be used by photometry.aperture_phot.assemble_lightcurve.
+
+    # Wraps align_frame function. The reference control points are detected
+    only once per detection setting of the ladder and reused for all
+    images. Frames are processed on a pool of
+    `n_jobs` processes, a frame that fails on all the `ladder` attempts is
+    left untouched and reported on the log table without stopping the
+    others.
 
     Parameters
     ----------
@@ -85,14 +632,34 @@ def align_all_images(
         ref_file : str
             Path to FITS with reference field. Default is None, so it takes
             the first file of the folder.
+        resample : bool
+            If True resample the images, otherwise only solve the transforms.
+            Default is True.
+        transforms_name : str
+            Name of the transforms table (successful frames), written inside
+            the images folder when resample is False.
+        n_jobs : int
+            Number of worker processes. Default is 1 (serial).
+        ladder : sequence of dicts
+            Attempts to make for each frame (see align_frame).
+        log_name : str
+            Name of the result table with one row per frame, written inside
+            the images folder.
+        translation_first : bool
+            If True try the phase correlation fast path for pure translations
+            before astroalign (see solve_translation). Default is False.
+        shift_mode : str
+            How to apply the fast path shift: "fourier" or "integer".
 
     Returns
     -------
-        None.
+        log : pd.DataFrame
+            Result table with one row per frame.
 
     File transformation
     -------------------
-        Re-write FITS files with aligned version.
+        Re-write FITS files with aligned version, or write the transforms
+        table. Write the result table.
     """
 
     with indir(images_folder):
@@ -103,18 +670,56 @@ def align_all_images(
             ref_file = images[0]
 
         ref_image = img_as_float64(fits.getdata(ref_file))
+        ref_points = ladder_control_points(ref_image, ladder=ladder,
+                                           max_control_points=max_control_points,
+                                           min_area=min_area)
+        ref_shape = ref_image.shape
+        del ref_image
+
+        # Absolute paths since workers may not share the working directory
+        images = [os.path.abspath(im) for im in images if not os.path.basename(im).startswith("a_")]
         N = len(images)
 
+        action = "Aligning" if resample else "Solving transforms of"
+        print(f"{action} {N} images with file {ref_file} in folder {images_folder}.\n")
+
+        kwargs = {"resample": resample,
+                  "max_control_points": max_control_points,
+                  "min_area": min_area,
+                  "ladder": ladder,
+                  "translation_first": translation_first,
+                  "ref_path": os.path.abspath(ref_file),
+                  "shift_mode": shift_mode}
+
+        rows = []
+
+        def report(row):
+            rows.append(row)
+            message = "done" if row["status"] == "ok" else f"FAILED ({row['error']})"
+            print(f"{row['file']}: {message} ({len(rows)} of {N}).")
+
+        if n_jobs <= 1:
+            for im in images:
+                report(align_frame(im, ref_shape, ref_points, ref_file, **kwargs))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                futures = [pool.submit(align_frame, im, ref_shape, ref_points, ref_file, **kwargs)
+                           for im in images]
+                for future in as_completed(futures):
+                    report(future.result())
+
+        # Don't keep the reference spectrum of the fast path alive
+        _reference_spectrum.cache_clear()
+
+        log = pd.DataFrame(rows).sort_values("file").reset_index(drop=True)
+        log.to_csv(log_name, index=False)
 
-        print(f"Aligning {N} images with file {ref_file} in folder {images_folder}.\n")
+        if not resample:
+            ok = log[log["status"] == "ok"]
+            (ok.reindex(columns=["file", "ref_file", "scale", "rotation", "tx", "ty"])
+             .to_csv(transforms_name, index=False))
 
-        for i, im in enumerate(images, start=1):
-            if "a_" not in im:
-                # try:
-                print(f"Aligning: {im} ({i} of {N}).")
-                align_with(im, ref_image, ref_file, max_control_points=max_control_points, min_area=min_area)
-                # except:
-                #     print(f"Some problem has happened with the alignment of image {im}")
-                #     continue
+        n_failed = (log["status"] != "ok").sum()
+        print(f"\n Finished alignment of {images_folder} images. {n_failed} failed, see {log_name}.")
 
-        print(f"\n Finished alignment of {images_folder} images.")
+    return log
@@ -8,11 +8,16 @@ Module containing CCD image reduction routines:
 import pandas as pd
 from pathlib import Path
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import shared_memory
 from astropy.io import fits
 import numpy as np
 from astropy.nddata import CCDData
 import ccdproc
 
+from . import stacking
+
 
 def _check_image_extensions(hdul):
     """
@@ -144,12 +149,16 @@ def _correct_overscan_hdu(hdu_ccd):
 
 
 
-def make_mbias(file_list, out_path):
+def make_mbias(file_list, out_path, mem_limit=2e9):
     """
     Given a list of bias image files, combine then into master bias using
     sigma clipping algorithm.  It is expected that the files are already
     pre-processed (overscan, trim, ...).
 
+    The stack is combined in blocks of rows (see `stacking.combine_files`) so
+    the memory used is bounded by `mem_limit` regardless of the number of
+    images.
+
     Arguments
     ---------
 
@@ -159,6 +168,9 @@ def make_mbias(file_list, out_path):
         out_path : pathlib.Path
             Location to put new image
 
+        mem_limit : float, default=2e9
+            Memory budget in bytes for the combination.
+
     File transformations
     --------------------
 
@@ -190,24 +202,14 @@ def make_mbias(file_list, out_path):
     #  Looping over extensions
     for i in image_indices:
 
-        #  Loading images of an extension
-        ccd_list = [CCDData.read(image_file, hdu=i, unit="adu") for image_file in file_list]
-
-        #  Correct overscan
-        if not ('BIASSEC' in ccd_list[0].header):
-            print(f".Skipping bias overscan correction on: index [{i:1.0f}] - BIASSEC keyword not found")
-        else:
-            for im in ccd_list:
-                im = _correct_overscan_hdu(im)
-
-        #  Combining images
-        comb = ccdproc.Combiner(ccd_list)
-        comb.sigma_clipping(low_thresh=3, high_thresh=3, func=np.ma.median)
-        comb_bias = comb.average_combine()
+        #  Combining images in row blocks
+        comb_bias = stacking.combine_files(file_list, hdu=i,
+                                           low_thresh=3, high_thresh=3,
+                                           mem_limit=mem_limit)
 
         #  Writing changes to the master bias file
-        mbias[i].header.append(('NCOMBINE', len(ccd_list), '# images combined'))
-        fits.update(out_pathname, comb_bias.data, header=mbias[i].header, ext=i)
+        mbias[i].header.append(('NCOMBINE', len(file_list), '# images combined'))
+        fits.update(out_pathname, comb_bias, header=mbias[i].header, ext=i)
 
     mbias.close()
     print(f"Processed master bias:  {out_pathname}")
@@ -246,11 +248,13 @@ def _center_inv_median(image_matrix):
     return inv_med
 
 
-def make_mflat(file_list, mbias_path, out_path, filter, scaling_func=_center_inv_median):
+def make_mflat(file_list, mbias_path, out_path, filter, scaling_func=_center_inv_median,
+               mem_limit=2e9):
     """
     Given a list of flat image files, combine then into master flat using
     sigma clipping algorithm, on the images after normalizing by the median. It
-    is expected that the files are already pre-processed (overscan, trim, ...).
+    is expected that the files are already pre-processed (overscan, trim,
+    bias, ...), no bias is subtracted here.
 
     Arguments
     ---------
@@ -259,7 +263,9 @@ def make_mflat(file_list, mbias_path, out_path, filter, scaling_func=_center_inv
             Paths for the files.
 
         mbias_path : str
-            Path to the master bias
+            Path to the master bias. Ignored, kept for compatibility (the
+            subtraction of previous versions never reached the combined
+            images).
 
         out_path : pathlib.Path
             Location to put new image
@@ -271,6 +277,9 @@ def make_mflat(file_list, mbias_path, out_path, filter, scaling_func=_center_inv
             Function or values to scale individual images. Default is
             _center_inv_median, which is defined on this module.
 
+        mem_limit : float, default=2e9
+            Memory budget in bytes for the combination.
+
     File transformations
     --------------------
 
@@ -302,28 +311,15 @@ def make_mflat(file_list, mbias_path, out_path, filter, scaling_func=_center_inv
     #  Looping over extensions
     for i in image_indices:
 
-        master_bias = CCDData.read(mbias_path, hdu=i, unit="adu")  #  Master bias
-        #  Loading images of an extension
-        ccd_list = [CCDData.read(image_file, hdu=i, unit="adu") for image_file in file_list]
-
-        for image in ccd_list:
-            image = ccdproc.subtract_bias(image, master_bias)
-
-        if not ('BIASSEC' in ccd_list[0].header):
-            print(f".Skipping flat overscan correction on: index [{i:1.0f}] - BIASSEC keyword not found")
-        else:
-            for im in ccd_list:
-                im = _correct_overscan_hdu(im)
-
-        #  Combining images
-        comb = ccdproc.Combiner(ccd_list)
-        comb.scaling = scaling_func #  Scalling using custom function
-        comb.sigma_clipping(low_thresh=3, high_thresh=3, func=np.ma.median)
-        comb_image = comb.average_combine()
+        #  Combining images in row blocks, scalling using custom function
+        comb_image = stacking.combine_files(file_list, hdu=i,
+                                            low_thresh=3, high_thresh=3,
+                                            scaling=scaling_func,
+                                            mem_limit=mem_limit)
 
         #  Writing changes to the master bias file
-        mflat[i].header.append(('NCOMBINE', len(ccd_list), '# images combined'))
-        fits.update(out_pathname, comb_image.data, header=mflat[i].header, ext=i)
+        mflat[i].header.append(('NCOMBINE', len(file_list), '# images combined'))
+        fits.update(out_pathname, comb_image, header=mflat[i].header, ext=i)
 
     mflat.close()
     print(f"Processed master flat on {filter} :  {out_pathname}")
@@ -331,11 +327,175 @@ def make_mflat(file_list, mbias_path, out_path, filter, scaling_func=_center_inv
     return {filter : out_pathname}
 
 
-def ccdred_list(image_path_list, mbias_path, mflat_path):
+def _ccdred_file(image_file, masters):
+    """
+    Apply overscan, trim, bias and flat corrections to all the extensions of a
+    FITS file, re-writing it.
+
+    Arguments
+    ---------
+
+        image_file : str
+            Path to the file to process
+
+        masters : dict
+            Extension index as key and a tuple (master bias, master flat) of
+            astropy.nddata.CCDData as values.
+
+    Returns
+    -------
+        None
+    """
+
+    for i, (mbias_ccd, mflat_ccd) in masters.items():
+
+        #  Get CCDData object for this extension
+
+        ccd = CCDData.read(image_file, unit="adu", hdu=i)
+
+        if 'CCDPROC' in ccd.header:
+            print(f"Skipping image: {image_file:1s}[{i:1.0f}] - Already processed.")
+            continue
+
+        #  Overscan section variables
+
+        biassec = None
+        trimsec = None
+
+        if "BIASSEC" in ccd.header:
+            biassec = ccd.header["BIASSEC"]
+
+        if "TRIMSEC" in ccd.header:
+            trimsec = ccd.header["TRIMSEC"]
+
+        # Applying corrections
+
+        ccd = ccdproc.ccd_process(
+                ccd,
+                oscan = biassec,
+                trim = trimsec,
+                master_bias = mbias_ccd,
+                master_flat = mflat_ccd
+                )
+
+        ##  Can add more information on the function above for the pixel by
+        ##  pixel error calculation (e.g. gain, read noise).
+
+        #  Updating existing image
+
+        ccd.header["CCDPROC"] = True  #  Added processed flag
+
+        fits.update(image_file, ccd.data.astype(np.float32), header=ccd.header, ext=i)
+
+        print(f"Processed image: {image_file}")
+
+
+#  Masters attached to the shared memory blocks on each worker process
+_worker_masters = {}
+_worker_blocks = []
+
+
+def _share_array(array, blocks):
+    """
+    Copy an array into a new shared memory block, appending the block to
+    `blocks`, and return a (name, shape, dtype) descriptor to attach to it.
+    """
+
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(shm)
+
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[:] = array
+
+    return shm.name, array.shape, array.dtype.str
+
+
+def _attach_array(descriptor):
+    """
+    Attach to a shared memory block given the descriptor created by
+    `_share_array`.
+    """
+
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    _worker_blocks.append(shm)
+
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _init_ccdred_worker(descriptors):
+    """
+    Pool initializer: wrap the shared masters as CCDData objects once per
+    worker.
+    """
+
+    for i, (bias, bias_header, flat, flat_header) in descriptors.items():
+        _worker_masters[i] = (
+                CCDData(data=_attach_array(bias), header=bias_header, unit="adu"),
+                CCDData(data=_attach_array(flat), header=flat_header, unit="adu")
+                )
+
+
+def _ccdred_worker(func, item):
+    """Call func(item, masters) with the masters of the worker (see _init_ccdred_worker)"""
+
+    func(item, _worker_masters)
+
+
+def _map_with_masters(func, items, mbias_path, mflat_path, n_jobs=1):
+    """
+    Call `func(item, masters)` for each item, where masters is a dict with the
+    extension index as key and a tuple (master bias, master flat) of CCDData
+    as value.
+
+    With `n_jobs` greater than 1 the master frames are placed once in shared
+    memory and the items are distributed over a pool of worker processes
+    (`func` has to be defined at module level).
+    """
+
+    with fits.open(mbias_path) as master_bias, fits.open(mflat_path) as master_flat:
+
+        image_indices = _check_image_extensions(master_bias)
+
+        if n_jobs <= 1:
+            masters = {
+                    i: (CCDData(data=master_bias[i].data, header=master_bias[i].header, unit="adu"),
+                        CCDData(data=master_flat[i].data, header=master_flat[i].header, unit="adu"))
+                    for i in image_indices
+                    }
+
+            for item in items:
+                func(item, masters)
+
+            return
+
+        blocks = []
+        try:
+            descriptors = {
+                    i: (_share_array(master_bias[i].data, blocks), master_bias[i].header,
+                        _share_array(master_flat[i].data, blocks), master_flat[i].header)
+                    for i in image_indices
+                    }
+
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_init_ccdred_worker,
+                                     initargs=(descriptors,)) as pool:
+                list(pool.map(_ccdred_worker, repeat(func), items))
+
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+
+def ccdred_list(image_path_list, mbias_path, mflat_path, n_jobs=1):
     """
     Given a list of FITS files process it by applying master calibrations and
     overscan.
 
+    With `n_jobs` greater than 1 the master frames are placed once in shared
+    memory and the files are distributed over a pool of worker processes.
+
     Arguments
     ---------
 
@@ -348,6 +508,9 @@ def ccdred_list(image_path_list, mbias_path, mflat_path):
         mflat_path : str
             Path to the master flats
 
+        n_jobs : int, default=1
+            Number of worker processes. Default is 1 (serial processing).
+
 
     File transformations
     --------------------
@@ -361,64 +524,99 @@ def ccdred_list(image_path_list, mbias_path, mflat_path):
         None
     """
 
-    #  Load masters
-
-    master_bias = fits.open(mbias_path)
-    master_flat = fits.open(mflat_path)
-
-    image_indices = _check_image_extensions(master_bias)
-
-    for image_file in image_path_list:
+    _map_with_masters(_ccdred_file, image_path_list, mbias_path, mflat_path, n_jobs=n_jobs)
 
-        #  Looping over extensions
-        for i in image_indices:
 
-            #  Get CCDData object for this extension
+def _reduce_file(paths, masters):
+    """
+    Read a raw FITS file once, apply overscan, trim, bias and flat corrections
+    to all its image extensions in memory and write the result on a new file.
 
-            ccd = CCDData.read(image_file, unit="adu", hdu=i)
+    Arguments
+    ---------
 
-            mbias_ccd = CCDData(data=master_bias[i].data,
-                                header=master_bias[i].header, unit="adu")
+        paths : tuple of str
+            Path to the raw file and to the output file.
 
-            mflat_ccd = CCDData(data=master_flat[i].data,
-                                header=master_flat[i].header, unit="adu")
+        masters : dict
+            Extension index as key and a tuple (master bias, master flat) of
+            astropy.nddata.CCDData as values.
 
-            if 'CCDPROC' in ccd.header:
-                print(f"Skipping image: {image_file:1s}[{i:1.0f}] - Already processed.")
-                continue
+    Returns
+    -------
+        None
+    """
 
-            #  Overscan section variables
+    image_file, out_file = paths
 
-            biassec = None
-            trimsec = None
+    if Path(out_file).exists():
+        print(f".Skipping {out_file}: File already exists")
+        return
 
-            if "BIASSEC" in ccd.header:
-                biassec = ccd.header["BIASSEC"]
+    with fits.open(image_file) as hdul:
+        hdus = list(hdul)
 
-            if "TRIMSEC" in ccd.header:
-                trimsec = ccd.header["TRIMSEC"]
+        for i, (mbias_ccd, mflat_ccd) in masters.items():
 
-            # Applying corrections
+            ccd = CCDData(data=hdul[i].data, header=hdul[i].header, unit="adu")
 
             ccd = ccdproc.ccd_process(
                     ccd,
-                    oscan = biassec,
-                    trim = trimsec,
+                    oscan = ccd.header.get("BIASSEC"),
+                    trim = ccd.header.get("TRIMSEC"),
                     master_bias = mbias_ccd,
                     master_flat = mflat_ccd
                     )
 
-            ##  Can add more information on the function above for the pixel by
-            ##  pixel error calculation (e.g. gain, read noise).
+            header = fits.Header(ccd.header)
+            header.remove("BIASSEC", ignore_missing=True)
+            header.remove("TRIMSEC", ignore_missing=True)
+            header["CCDPROC"] = True  #  Added processed flag
+
+            hdu_class = fits.PrimaryHDU if i == 0 else fits.ImageHDU
+            hdus[i] = hdu_class(data=ccd.data.astype(np.float32), header=header)
+
+        fits.HDUList(hdus).writeto(out_file)
+
+    print(f"Processed image: {image_file} ====> {out_file}")
+
+
+def ccdred_to_files(image_path_list, out_path_list, mbias_path, mflat_path, n_jobs=1):
+    """
+    Given a list of raw FITS files process each one in a single pass (overscan,
+    trim, bias and flat) writing the reduced image on the matching output
+    path.  The raw files are read once and not modified.
+
+    Arguments
+    ---------
+
+        image_path_list : list like with strings
+            Path to the raw files to process
 
-            #  Updating existing image
+        out_path_list : list like with strings
+            Path to the files to create (same order as image_path_list)
+
+        mbias_path : str
+            Path to the master bias
+
+        mflat_path : str
+            Path to the master flats
+
+        n_jobs : int, default=1
+            Number of worker processes. Default is 1 (serial processing).
 
-            ccd.header["CCDPROC"] = True  #  Added processed flag
 
-            fits.update(image_file, ccd.data.astype(np.float32), header=ccd.header, ext=i)
+    File transformations
+    --------------------
 
-            print(f"Processed image: {image_file}")
+        Write the reduced FITS files (float32) on the output paths.
 
-    master_bias.close()
-    master_flat.close()
 
+    Returns
+    -------
+        None
+    """
+
+    _map_with_masters(_reduce_file,
+                      list(zip(map(str, image_path_list), map(str, out_path_list))),
+                      mbias_path, mflat_path, n_jobs=n_jobs)
@@ -2,10 +2,14 @@
 Functions to combine batches of images.
 """
 import numpy as np
+import pandas as pd
 from astropy.io import fits
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from wdpipe.utils.context_managers import indir
+from wdpipe.utils.fits_io import load_frame, FrameCache
+from wdpipe.pre_processing.stacking import median_combine, combine_cube, frame_weights
 
 
 def group_images(final_selection, exptime, n=5):
@@ -122,7 +126,7 @@ def generate_combination_bins(data_folder, final_selection, exptime, bin_size, o
     return usable_index_chunks
 
 
-def combine_batch(batch, update_name):
+def combine_batch(batch, update_name, cache=None, method="median", weights=None, **kwargs):
     """
     From a text file containing FITS files names, combine all images and
     generate new reference header.  Give back the new matrix and header. Used
@@ -131,25 +135,66 @@ def combine_batch(batch, update_name):
     Args:
         batch -- List of strings with path to batch text file.
         update_name -- String with the exit name.
+        cache -- utils.fits_io.FrameCache to take the frames from or None
+                 (default) to read them from disk.
+        method -- String with the combination kernel: "median" (default),
+                  "sigma_clip", "minmax" or "percentile_clip" (see
+                  stacking.combine_cube).
+        weights -- List of floats with one weight per frame (see
+                   stacking.frame_weights) or None.
+        kwargs -- Passed to the kernel (e.g. low_thresh, nlow, high).
 
     Return:
         combination -- 2D numpy array containing combined image
         ref_header -- Astropy header object with updated info.
     """
-    # Load images and headers
+    # Load images into a preallocated float32 cube, one open per file
 
-    images = [fits.getdata(file) for file in batch]
-    headers = [fits.getheader(file) for file in batch]
+    cube = None
+    headers = []
+    for k, file in enumerate(batch):
+        if cache is not None:
+            data, header = cache.get(file)
+        else:
+            data, header = load_frame(file, memmap=True)
+
+        if cube is None:
+            cube = np.empty((len(batch), *data.shape), dtype=np.float32)
+
+        cube[k] = data
+        headers.append(header)
+
+    ref_header = _reference_header(batch, headers, update_name)
+
+    # Combine images (in blocks of rows)
+
+    combination = combine_cube(cube, method=method, weights=weights, **kwargs)
+
+    return (combination, ref_header)
+
+
+def _reference_header(batch, headers, update_name):
+    """
+    Generate the header of a combination from the headers of the combined
+    images (mean JD and AIRMASS, IMCMB cards, ...).
 
+    Args:
+        batch -- List of strings with the combined file names.
+        headers -- List of astropy headers (same order as batch).
+        update_name -- String with the exit name.
+
+    Return:
+        ref_header -- Astropy header object with updated info.
+    """
     #  New parameters
     airmasses = np.array([np.float64(header["AIRMASS"]) for header in headers])
     jds = np.array([np.float64(header["JD"]) for header in headers])
-    ncombine = len(images)
+    ncombine = len(batch)
     middle = int(ncombine/2)
     date = headers[middle]["DATE-OBS"]
 
     # Generate reference header
-    ref_header = headers[middle]
+    ref_header = headers[middle].copy()
     ref_header["JD"] = jds.mean()
     ref_header["AIRMASS"] = airmasses.mean()
     ref_header["NCOMBINE"] = ncombine
@@ -158,16 +203,37 @@ def combine_batch(batch, update_name):
         ref_header[f"IMCMB{i}"] = file
     ref_header["IMAGE"] = update_name
 
-    # Combine images
+    return ref_header
 
-    cube = np.stack(images, axis=0)
 
-    combination = np.median(cube, axis=0)
+def _read_batches(batches_folder):
+    """
+    Read the batch text files of a folder (sorted by name).
 
-    return (combination, ref_header)
+    Args:
+        batches_folder -- String with path to batch folder.
 
+    Return:
+        batches -- List of lists of strings with the file names.
+        stem -- String with the stem for the combination names.
+    """
+    batches = []
+    files = os.listdir(batches_folder)
+    files.sort()
+
+    for batch in files:
+        with open(batches_folder + "/" + batch) as f:
+            batches.append([line.strip() for line in f])
+
+    # Define new stem name
+    ref_file = batches[0][0].split("_")
+    stem = f"final_{ref_file[1]}_{ref_file[2]}"
+
+    return batches, stem
 
-def combine_batches(images_folder, batches_folder="batches", out_folder="combinated"):
+
+def combine_batches(images_folder, batches_folder="batches", out_folder="combinated",
+                    n_jobs=1, cache_bytes=2e9, method="median", parameters=None, **kwargs):
     """
     From a text file containing FITS files names, combine all images and
     generate new reference header.  Give back the new matrix and header.
@@ -177,11 +243,23 @@ def combine_batches(images_folder, batches_folder="batches", out_folder="combina
 
     OBS1: Expects that the batch folder is already created.
 
+    Batches are combined on a pool of `n_jobs` threads sharing a LRU cache of
+    decoded frames (utils.fits_io.FrameCache) of `cache_bytes`, so
+    neighbouring batches sharing frames don't read them twice.
+
     Args:
         images_folder -- String with path to the folder with the images.
         batches_folder -- Strings with path to batch folder files relative to
                           the images folder.
         out_folder -- String with the exit folder name relative to .
+        n_jobs -- Integer with the number of threads (default 1).
+        cache_bytes -- Float with the size of the frame cache in bytes
+                       (default 2e9). Set to 0 to disable the cache.
+        method -- String with the combination kernel (see combine_batch).
+        parameters -- String with path to the inspection parameters file (or
+                      pd.DataFrame) to weight the frames by FWHM and
+                      sky_sigma, or None (default) for no weights.
+        kwargs -- Passed to the kernel (e.g. low_thresh, nlow, high).
 
     Return:
         List of strings with path to created files.
@@ -194,27 +272,34 @@ def combine_batches(images_folder, batches_folder="batches", out_folder="combina
         os.mkdir(out_folder)
 
         # Load Batches
-        batches = []
-        files = os.listdir(batches_folder)
-        files.sort()
+        batches, stem = _read_batches(batches_folder)
+        N = len(batches)
 
-        for batch in files:
-            with open(batches_folder + "/" + batch) as f:
-                batches.append([line.strip() for line in f])
+        cache = FrameCache(max_bytes=cache_bytes) if cache_bytes > 0 else None
 
-        # Define new stem name
-        ref_file = batches[0][0].split("_")
-        stem = f"final_{ref_file[1]}_{ref_file[2]}"
-        N = len(batches)
+        if isinstance(parameters, str):
+            parameters = pd.read_csv(parameters)
 
         # For each batch combine_batch them save results
-        for i, batch in enumerate(batches, start=1):
+        def combine(i, batch):
             new_name = f"{stem}_{i:04}"
             print(f"Combining batch: {batch}")
             print(f"Creating image: {new_name} ({i} de {N})")
-            matrix, new_header = combine_batch(batch, new_name)
+            weights = frame_weights(batch, parameters) if parameters is not None else None
+            matrix, new_header = combine_batch(batch, new_name, cache=cache, method=method,
+                                               weights=weights, **kwargs)
             fits.writeto(f"{out_folder}/{new_name}.fits", matrix.astype(np.float32), header=new_header)
 
+        if n_jobs <= 1:
+            for i, batch in enumerate(batches, start=1):
+                combine(i, batch)
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+                list(pool.map(combine, range(1, N + 1), batches))
+
+        if cache is not None:
+            print(f"Frame cache: {cache.misses} reads, {cache.hits} hits.")
+
         new_fits = os.listdir(f"{images_folder}/{out_folder}")
         new_fits.sort()
 
@@ -222,6 +307,99 @@ def combine_batches(images_folder, batches_folder="batches", out_folder="combina
     return new_fits
 
 
+def combine_sliding_batches(images_folder, batches_folder="batches", out_folder="combinated",
+                            method="median"):
+    """
+    Same as combine_batches but for overlapping batches (as generated by
+    generate_combination_bins with overlap): the frames of the current batch
+    are kept in a ring buffer cube, so each frame is read only once while it
+    stays on the window. Frames entering the window are loaded on the slot of
+    the ones leaving it.
+
+    With method "mean" the sum of the window is updated incrementally (adding
+    the entering frames and subtracting the leaving ones). With "median" the
+    median is taken over the cached slices.
+
+    Args:
+        images_folder -- String with path to the folder with the images.
+        batches_folder -- Strings with path to batch folder files relative to
+                          the images folder.
+        out_folder -- String with the exit folder name relative to .
+        method -- String with the combination: "median" (default) or "mean".
+
+    Return:
+        List of strings with path to created files.
+
+    File transformations:
+        Write new FITS files for the combinations.
+    """
+    if method not in ("median", "mean"):
+        raise ValueError(f"Unknown combination method: {method}")
+
+    with indir(images_folder):
+
+        os.mkdir(out_folder)
+
+        batches, stem = _read_batches(batches_folder)
+        N = len(batches)
+        capacity = max(len(batch) for batch in batches)
+
+        cube = None      # Ring buffer (capacity, ny, nx)
+        total = None     # Running sum of the window (mean)
+        slots = {}       # file -> (slot, header)
+        n_read = 0
+
+        for i, batch in enumerate(batches, start=1):
+            new_name = f"{stem}_{i:04}"
+            print(f"Combining batch: {batch}")
+            print(f"Creating image: {new_name} ({i} de {N})")
+
+            # Drop frames leaving the window
+            for file in [file for file in slots if file not in batch]:
+                slot, _ = slots.pop(file)
+                if total is not None:
+                    total -= cube[slot]
+
+            free = sorted(set(range(capacity)) - {slot for slot, _ in slots.values()})
+
+            # Load frames entering the window
+            for file in batch:
+                if file in slots:
+                    continue
+
+                data, header = load_frame(file, memmap=True)
+                n_read += 1
+
+                if cube is None:
+                    cube = np.empty((capacity, *data.shape), dtype=np.float32)
+                    if method == "mean":
+                        total = np.zeros(data.shape, dtype=np.float64)
+
+                slot = free.pop(0)
+                cube[slot] = data
+                slots[file] = (slot, header)
+
+                if total is not None:
+                    total += cube[slot]
+
+            used = sorted(slot for slot, _ in slots.values())
+
+            if method == "mean":
+                matrix = total/len(batch)
+            else:
+                matrix = median_combine(cube, frames=None if len(used) == capacity else used)
+
+            new_header = _reference_header(batch, [slots[file][1] for file in batch], new_name)
+            fits.writeto(f"{out_folder}/{new_name}.fits", matrix.astype(np.float32), header=new_header)
+
+        print(f"Read {n_read} frames for {N} batches.")
+
+        new_fits = os.listdir(out_folder)
+        new_fits.sort()
+
+    return new_fits
+
+
 def chunk_collection(collection, chunk_size, overlap=0):
     """
     Given a `collection` it will divide it into chunks of `chunk_size` with an
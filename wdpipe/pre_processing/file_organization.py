@@ -63,7 +63,8 @@ def move_files(files, destination):
             
     File transformations
     --------------------
-        Move files to the specified destination
+        Move files to the specified destination and transfer their entries
+        on the header index (see nightlog.index_headers).
 
     Returns
     -------
@@ -72,9 +73,14 @@ def move_files(files, destination):
     quantity = len(files)
     print(f"Moving {quantity} files... \n")
 
+    moves = []
     for i, file in enumerate(files, start=1):
         print(f"{file} ====> {destination}/{file} ({i} de {quantity})")
-        move(file, str(Path(f"{destination}/{file}")))
+        dest = Path(f"{destination}/{file}")
+        move(file, str(dest))
+        moves.append((file, dest))
+
+    nightlog.move_index_entries(moves)
     
     print("\n")
 
@@ -135,7 +141,7 @@ def sep_by_kw(folder, key):
     
     return new_folders
 
-def organize_nightrun(folder, out_location=None):
+def organize_nightrun(folder, out_location=None, copy_science=True):
     """
     Organize files of a night run into a folder structure in a new folder.
     
@@ -152,6 +158,11 @@ def organize_nightrun(folder, out_location=None):
             Path to folder on which to create the reduction folder. Default
             is None, it creates the reduction folder on the same directory
             of the original.
+
+        copy_science : bool
+            If True copy the science images into the reduced folder. Default
+            is True. Set to False when the science images are calibrated
+            directly from the original folder (see ccdred.ccdred_to_files).
             
     Returns
     -------
@@ -217,9 +228,10 @@ def organize_nightrun(folder, out_location=None):
     
     copy_files(folder / flats, folders["flat"])
 
-    print("Copying science images ...\n")
-        
-    copy_files(folder / sci, folders["reduced"])
+    if copy_science:
+        print("Copying science images ...\n")
+
+        copy_files(folder / sci, folders["reduced"])
     
     #   Organize flat files
     
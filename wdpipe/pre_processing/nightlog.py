@@ -15,9 +15,195 @@ Basic usage:
 import ccdproc
 import pandas as pd
 import os
+import json
+import fnmatch
+import sqlite3
 from pathlib import Path
+from collections import defaultdict
 
-def get_log(folder, extra_keys=[], write=False):
+from wdpipe.utils.fits_io import load_header
+
+INDEX_NAME = ".headers_index.sqlite"
+
+#  File name patterns taken as FITS, the same as ccdproc.ImageFileCollection
+FITS_PATTERNS = [f"*{extension}{compression}"
+                 for compression in ("", ".gz", ".bz2", ".Z", ".zip", ".fz")
+                 for extension in ("fit", "fits", "fts")]
+
+
+def fits_files(folder):
+    """
+    Paths of the FITS files of a folder (matching FITS_PATTERNS), sorted by
+    name. (str -> list of pathlib.Path)
+    """
+    names = os.listdir(folder)
+    found = {name for pattern in FITS_PATTERNS for name in fnmatch.filter(names, pattern)}
+
+    return [Path(folder) / name for name in sorted(found)]
+
+
+def _header_to_dict(header):
+    """
+    Convert a FITS header into a JSON serializable dict with upper case keys.
+    COMMENT and HISTORY entries are joined with commas, as done by
+    ccdproc.ImageFileCollection. (fits.Header -> dict)
+    """
+    values = {}
+    multi_entry = {"COMMENT": [], "HISTORY": []}
+
+    for key, value in header.items():
+        if key == "":
+            continue
+
+        key = key.upper()
+
+        if key in multi_entry:
+            multi_entry[key].append(str(value))
+            continue
+
+        if key in values:
+            continue
+
+        if not isinstance(value, (str, int, float)):
+            value = None
+
+        values[key] = value
+
+    for key, entries in multi_entry.items():
+        if entries:
+            values[key] = ",".join(entries)
+
+    return values
+
+
+def _open_index(folder):
+    """
+    Open (creating if needed) the header index of a folder.
+    (str -> sqlite3.Connection)
+    """
+    con = sqlite3.connect(Path(folder) / INDEX_NAME)
+    con.execute("""CREATE TABLE IF NOT EXISTS headers (
+                       file TEXT PRIMARY KEY,
+                       size INTEGER,
+                       mtime INTEGER,
+                       header TEXT)""")
+    return con
+
+
+def index_headers(folder):
+    """
+    Return the primary headers of the FITS files in a folder using a
+    persistent index stored on the folder (file named INDEX_NAME).
+
+    Entries are keyed by the file name, size and modification time, so only
+    new or changed files are read. Entries of files no longer in the folder
+    are dropped.
+
+    Parameters
+    ----------
+
+    folder : str
+        Path to the folder with the FITS files.
+
+    Returns
+    -------
+
+    headers : dict
+        File name as key and a dict with the header values as value (sorted
+        by file name).
+
+    File transformations
+    --------------------
+
+    Create or update the index file inside the folder.
+    """
+
+    folder = Path(folder)
+    files = fits_files(folder)
+
+    with _open_index(folder) as con:
+        cached = {file: (size, mtime, header) for file, size, mtime, header
+                  in con.execute("SELECT file, size, mtime, header FROM headers")}
+
+        headers = {}
+        updates = []
+        for path in files:
+            stat = path.stat()
+            entry = cached.pop(path.name, None)
+
+            if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                headers[path.name] = json.loads(entry[2])
+                continue
+
+            headers[path.name] = _header_to_dict(load_header(path))
+            updates.append((path.name, stat.st_size, stat.st_mtime_ns,
+                            json.dumps(headers[path.name])))
+
+        con.executemany("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)", updates)
+        con.executemany("DELETE FROM headers WHERE file = ?", [(file,) for file in cached])
+
+    con.close()
+
+    if updates:
+        print(f"Header index of {folder}: read {len(updates)} of {len(files)} files.")
+
+    return headers
+
+
+def move_index_entries(moves):
+    """
+    Transfer index entries of moved files to the index of their new folder,
+    so a move doesn't force the headers to be read again.
+
+    Entries are only transferred when the moved file keeps the size and
+    modification time stored on the index. Folders without index are left
+    untouched.
+
+    Parameters
+    ----------
+
+    moves : list of tuples
+        Pairs (source, destination) of paths of the files already moved.
+
+    Returns
+    -------
+
+    None
+
+    File transformations
+    --------------------
+
+    Update the index files on the source and destination folders.
+    """
+
+    by_folders = defaultdict(list)
+    for src, dest in moves:
+        src, dest = Path(src), Path(dest)
+        by_folders[(src.parent, dest.parent)].append((src.name, dest))
+
+    for (src_folder, dest_folder), entries in by_folders.items():
+        if not (src_folder / INDEX_NAME).exists():
+            continue
+
+        with _open_index(src_folder) as con:
+            rows = []
+            for name, dest in entries:
+                row = con.execute("SELECT size, mtime, header FROM headers WHERE file = ?",
+                                  (name,)).fetchone()
+                con.execute("DELETE FROM headers WHERE file = ?", (name,))
+
+                stat = dest.stat()
+                if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+                    rows.append((dest.name, *row))
+        con.close()
+
+        if rows:
+            with _open_index(dest_folder) as con:
+                con.executemany("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)", rows)
+            con.close()
+
+
+def get_log(folder, extra_keys=[], write=False, use_index=True):
     """
     Given a folder, it generate a log file with the listing of the keys given
     on the keys parameter. Default are the keys from OPD.
@@ -34,6 +220,13 @@ def get_log(folder, extra_keys=[], write=False):
     write : bool
         If True writes an output csv (default is True).
 
+    use_index : bool
+        If True the headers are taken from the persistent index of the folder
+        (see index_headers), reading only new or changed files. Otherwise,
+        or when the index can't be opened or written (e.g. read-only
+        folder), all files are read with ccdproc.ImageFileCollection
+        (default is True).
+
     Retuns
     ------
 
@@ -55,7 +248,7 @@ def get_log(folder, extra_keys=[], write=False):
 
     #  Check if there are fles
 
-    if len(list(out.glob("*.fits"))) == 0:
+    if len(fits_files(out)) == 0:
         print("ERROR: No files found, can't create log dataframe for orientation. Returning None")
         return None
 
@@ -66,9 +259,24 @@ def get_log(folder, extra_keys=[], write=False):
 
     keys.extend(extra_keys)
 
-    ifc = ccdproc.ImageFileCollection(folder, keywords=keys)
-    
-    df = ifc.summary.to_pandas(index="file")
+    headers = None
+    if use_index:
+        try:
+            headers = index_headers(folder)
+        except (sqlite3.Error, OSError) as error:
+            print(f"Header index of {folder} not available ({error}), reading all headers.")
+
+    if headers is not None:
+        df = pd.DataFrame.from_dict(
+                {file: {key: header.get(key) for key in keys}
+                 for file, header in headers.items()},
+                orient="index",
+                columns=keys)
+        df.index.name = "file"
+    else:
+        ifc = ccdproc.ImageFileCollection(folder, keywords=keys)
+
+        df = ifc.summary.to_pandas(index="file")
 
     # Cleaning OPD comment and exptime. Then standardizing OBJECT and FILTER.
 
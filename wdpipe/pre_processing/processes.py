@@ -9,7 +9,7 @@ from pathlib import Path
 from shutil import rmtree
 
 
-def initial_reduction(nightrun_folder, out_location=None):
+def initial_reduction(nightrun_folder, out_location=None, n_jobs=1):
     """
     Given a folder perform all the initial reduction process:
         - Organize files
@@ -17,6 +17,9 @@ def initial_reduction(nightrun_folder, out_location=None):
         - Correct overscan
         - Apply masters calibration files
 
+    See fused_reduction for a version that calibrates the science images in
+    a single read/write pass.
+
     Parameters
     ----------
         nightrun_folder : str
@@ -27,6 +30,10 @@ def initial_reduction(nightrun_folder, out_location=None):
             is None, it creates the reduction folder on the same directory
             of the original.
 
+        n_jobs : int, default=1
+            Number of worker processes used to apply the calibrations on the
+            science images.
+
     File transformations
     --------------------
         Create a copy of all files, organize them into a folder tree,
@@ -42,22 +49,7 @@ def initial_reduction(nightrun_folder, out_location=None):
 
     folders = organize_nightrun(nightrun_folder, out_location=out_location)
 
-    # Correcting bias and combining into master
-
-    print(f"\nProcessing bias images.\n")
-
-    bias_list = [str(path) for path in folders["bias"].glob("*.fits")]
-
-    mbias = ccdred.make_mbias(bias_list, folders["master"])
-
-    #  Correcting flats and combining into masters
-
-    print("\nProcessing flat images. \n")
-
-    mflats = {}
-    for filt in folders["flat"]:
-        flat_list = [str(path) for path in folders["flat"][filt].glob("*.fits")]
-        mflats.update(ccdred.make_mflat(flat_list, mbias, folders["master"], filt))
+    mbias, mflats = _make_masters(folders)
 
     #  Correct overscan of sci images
 
@@ -83,7 +75,7 @@ def initial_reduction(nightrun_folder, out_location=None):
 
         #  Apply ccdproc
         if filt in mflats:
-            ccdred.ccdred_list(files, mbias, mflats[filt])
+            ccdred.ccdred_list(files, mbias, mflats[filt], n_jobs=n_jobs)
 
         else:
             print(f"WARNING: No flat available for {filt} filter.")
@@ -104,14 +96,75 @@ def initial_reduction(nightrun_folder, out_location=None):
             # Separate filters by exptime
             sep_by_kw(filt, "EXPTIME")
 
-    # Check and remove unnecessary calibration files
+    _clean_calibrations(folders, mbias, mflats)
+
+    print("Processing finished.")
+
+
+def _make_masters(folders):
+    """
+    Combine the bias and flat images of an organized night run into masters.
+
+    Parameters
+    ----------
+        folders : dict
+            Folders created with organize_nightrun.
+
+    Returns
+    -------
+        mbias : str
+            Path to the master bias.
+
+        mflats : dict
+            Filter as key and path to the master flat as value.
+    """
+
+    # Correcting bias and combining into master
+
+    print(f"\nProcessing bias images.\n")
+
+    bias_list = [str(path) for path in folders["bias"].glob("*.fits")]
+
+    mbias = ccdred.make_mbias(bias_list, folders["master"])
+
+    #  Correcting flats and combining into masters
+
+    print("\nProcessing flat images. \n")
+
+    mflats = {}
+    for filt in folders["flat"]:
+        flat_list = [str(path) for path in folders["flat"][filt].glob("*.fits")]
+        mflats.update(ccdred.make_mflat(flat_list, mbias, folders["master"], filt))
+
+    return mbias, mflats
+
+
+def _clean_calibrations(folders, mbias, mflats):
+    """
+    Remove the calibration images of an organized night run for which the
+    masters were created.
+
+    Parameters
+    ----------
+        folders : dict
+            Folders created with organize_nightrun.
+
+        mbias : str
+            Path to the master bias.
+
+        mflats : dict
+            Filter as key and path to the master flat as value.
+
+    Returns
+    -------
+        None
+    """
 
     # Converting to path object
 
     mbias = Path(mbias)
 
-    for filter in mflats:
-        mflats[filter] = Path(mflats[filter])
+    mflats = {filter: Path(flat) for filter, flat in mflats.items()}
 
     # Check existance of file
 
@@ -130,4 +183,67 @@ def initial_reduction(nightrun_folder, out_location=None):
     if len(mflats) + 1 == n:
         rmtree(folders["bias"].parent)
 
+
+def fused_reduction(nightrun_folder, out_location=None, n_jobs=1):
+    """
+    Given a folder perform all the initial reduction process like
+    initial_reduction, but calibrating the science images in a single pass:
+    each raw image is read once from the original folder, corrected for
+    overscan, trim, bias and flat in memory and written directly into its
+    final OBJECT/FILTER/EXPTIME folder.
+
+    Parameters
+    ----------
+        nightrun_folder : str
+            Path to the folder to reduce
+
+        out_location : str or None 
+            Path to folder on which to create the reduction folder. Default
+            is None, it creates the reduction folder on the same directory
+            of the original.
+
+        n_jobs : int, default=1
+            Number of worker processes used to calibrate the science images.
+
+    File transformations
+    --------------------
+        Create a copy of the calibration files, create master files and write
+        the calibrated science images into a folder tree. Images on filters
+        without flat aren't written.
+
+    Returns
+    -------
+        None
+    """
+
+    print(f"Starting to process folder {nightrun_folder} \n")
+
+    folders = organize_nightrun(nightrun_folder, out_location=out_location, copy_science=False)
+
+    mbias, mflats = _make_masters(folders)
+
+    log_df, _ = get_log(Path(nightrun_folder), write=False)
+
+    sci = log_df[log_df["COMMENT"] == "science"]
+
+    print(f"\nProcessing {len(sci)} science images. \n")
+
+    for filt, group in sci.groupby("FILTER"):
+
+        if filt not in mflats:
+            print(f"WARNING: No flat available for {filt} filter. Skipping {len(group)} images.")
+            continue
+
+        files = [Path(nightrun_folder) / file for file in group.index]
+
+        out_files = [folders["reduced"] / str(row.OBJECT) / str(filt) / str(row.EXPTIME) / file
+                     for file, row in group.iterrows()]
+
+        for path in set(out_file.parent for out_file in out_files):
+            path.mkdir(parents=True, exist_ok=True)
+
+        ccdred.ccdred_to_files(files, out_files, mbias, mflats[filt], n_jobs=n_jobs)
+
+    _clean_calibrations(folders, mbias, mflats)
+
     print("Processing finished.")
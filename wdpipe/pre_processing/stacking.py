@@ -0,0 +1,342 @@
+"""
+Out-of-core combination of image stacks.
+
+The functions here combine a list of FITS files extension by extension
+reading the frames in blocks of rows, so only a slice of the stack is in
+memory at any time.  Reads are made through memory mapped sections and the
+stack is kept in float32.
+"""
+from contextlib import ExitStack
+
+import numpy as np
+from astropy.io import fits
+
+
+def row_blocks(shape, n_frames, mem_limit=2e9, itemsize=4, overhead=4):
+    """
+    Split the rows of an image into blocks so that a cube of `n_frames`
+    blocks fit within `mem_limit` bytes.
+
+    Parameters
+    ----------
+        shape : tuple of int
+            Shape (ny, nx) of the images.
+
+        n_frames : int
+            Number of images on the stack.
+
+        mem_limit : float, default=2e9
+            Memory budget in bytes.
+
+        itemsize : int, default=4
+            Size in bytes of each pixel (4 for float32).
+
+        overhead : int, default=4
+            Number of cube sized temporaries expected during the combination.
+
+    Returns
+    -------
+        blocks : list of slice
+            Row slices covering the whole image.
+    """
+    ny, nx = shape
+    bytes_per_row = n_frames * nx * itemsize * overhead
+    rows = max(1, int(mem_limit // bytes_per_row))
+
+    return [slice(start, min(start + rows, ny)) for start in range(0, ny, rows)]
+
+
+def sigma_clip_average(cube, low_thresh=3, high_thresh=3, scaling=None):
+    """
+    Combine a cube of images along the first axis by averaging after a single
+    pass of sigma clipping around the median.
+
+    Reproduces `ccdproc.Combiner.sigma_clipping(func=np.ma.median)` followed
+    by `average_combine()`: the clipping is done over the unscaled values and
+    the average over the scaled ones.
+
+    Parameters
+    ----------
+        cube : np.ndarray
+            3D array (frames, rows, columns).
+
+        low_thresh, high_thresh : float, default=3
+            Number of standard deviations bellow and above the median to clip.
+
+        scaling : np.ndarray or None, default=None
+            1D array with one scaling factor per frame.
+
+    Returns
+    -------
+        average : np.ndarray
+            2D float32 array with the combination.
+    """
+    center = np.median(cube, axis=0)
+    dev = np.std(cube, axis=0)
+
+    keep = cube >= center - low_thresh*dev
+    keep &= cube <= center + high_thresh*dev
+    del center, dev
+
+    if scaling is not None:
+        cube = cube * np.asarray(scaling, dtype=np.float32)[:, None, None]
+
+    total = np.where(keep, cube, 0).sum(axis=0, dtype=np.float64)
+    count = keep.sum(axis=0)
+
+    average = np.divide(total, count, out=np.full(total.shape, np.nan), where=count > 0)
+
+    return average.astype(np.float32)
+
+
+def _partition_median(block, axis=0):
+    """Median along an axis using np.partition"""
+    n = block.shape[axis]
+    middle = n // 2
+    kth = [middle - 1, middle] if n % 2 == 0 else [middle]
+    part = np.partition(block, kth, axis=axis)
+
+    return np.take(part, kth, axis=axis).mean(axis=axis)
+
+
+def median_combine(cube, mem_limit=2e8, frames=None):
+    """
+    Median of a cube of images along the first axis computed in blocks of
+    rows with `np.partition`, so the extra memory used is bounded by
+    `mem_limit` instead of a full copy of the cube.
+
+    Parameters
+    ----------
+        cube : np.ndarray
+            3D array (frames, rows, columns).
+
+        mem_limit : float, default=2e8
+            Memory budget in bytes for the temporary blocks.
+
+        frames : list of int or None, default=None
+            Indexes of the frames of the cube to combine (e.g. the used
+            slots of a ring buffer), taken block by block. All if None.
+
+    Returns
+    -------
+        median : np.ndarray
+            2D float32 array with the median.
+    """
+    n_frames = cube.shape[0] if frames is None else len(frames)
+    median = np.empty(cube.shape[1:], dtype=np.float32)
+
+    for block in row_blocks(cube.shape[1:], n_frames, mem_limit=mem_limit,
+                            itemsize=cube.itemsize, overhead=1):
+        median[block] = _partition_median(cube[:, block] if frames is None
+                                          else cube[frames, block])
+
+    return median
+
+
+def _weighted_mean(block, keep, weights=None):
+    """
+    Mean along the first axis of the kept values, weighted by one weight per
+    frame. Pixels with no kept value are NaN.
+    """
+    w = keep if weights is None else keep*np.asarray(weights, dtype=np.float32)[:, None, None]
+
+    total = (np.where(keep, block, 0)*w).sum(axis=0, dtype=np.float64)
+    norm = w.sum(axis=0, dtype=np.float64)
+
+    return np.divide(total, norm, out=np.full(total.shape, np.nan), where=norm > 0)
+
+
+def median_kernel(block, weights=None):
+    """
+    Median of a block along the first axis (weights are ignored).
+    """
+    return _partition_median(block)
+
+
+def sigma_clip_kernel(block, weights=None, low_thresh=3, high_thresh=3):
+    """
+    Reject values more than `low_thresh`/`high_thresh` standard deviations
+    bellow/above the median of each pixel (one pass) and average the rest.
+    """
+    center = _partition_median(block)
+    dev = block.std(axis=0)
+
+    keep = block >= center - low_thresh*dev
+    keep &= block <= center + high_thresh*dev
+
+    return _weighted_mean(block, keep, weights)
+
+
+def minmax_kernel(block, weights=None, nlow=1, nhigh=1):
+    """
+    Reject the `nlow` lowest and `nhigh` highest values of each pixel and
+    average the rest.
+    """
+    n = block.shape[0]
+    if nlow + nhigh >= n:
+        raise ValueError(f"Can't reject {nlow + nhigh} values from {n} frames")
+
+    kth = sorted({nlow, n - nhigh - 1})
+    order = np.argpartition(block, kth, axis=0)[nlow:n - nhigh]
+
+    kept = np.take_along_axis(block, order, axis=0)
+    w = None if weights is None else np.asarray(weights, dtype=np.float32)[order]
+
+    if w is None:
+        return kept.mean(axis=0, dtype=np.float64)
+
+    return (kept*w).sum(axis=0, dtype=np.float64)/w.sum(axis=0, dtype=np.float64)
+
+
+def percentile_clip_kernel(block, weights=None, low=10, high=90):
+    """
+    Reject values outside the [`low`, `high`] percentiles (nearest rank) of
+    each pixel and average the rest.
+    """
+    n = block.shape[0]
+    kth = sorted({int(round(low/100*(n - 1))), int(round(high/100*(n - 1)))})
+
+    part = np.partition(block, kth, axis=0)
+    lower, upper = part[kth[0]], part[kth[-1]]
+    del part
+
+    keep = (block >= lower) & (block <= upper)
+
+    return _weighted_mean(block, keep, weights)
+
+
+#  Combination methods available to combine_cube
+KERNELS = {
+        "median": median_kernel,
+        "sigma_clip": sigma_clip_kernel,
+        "minmax": minmax_kernel,
+        "percentile_clip": percentile_clip_kernel,
+        }
+
+
+def combine_cube(cube, method="median", weights=None, mem_limit=2e8, **kwargs):
+    """
+    Combine a cube of images along the first axis with one of the KERNELS,
+    processing it in blocks of rows so the temporaries are bounded by
+    `mem_limit`.
+
+    Parameters
+    ----------
+        cube : np.ndarray
+            3D float32 array (frames, rows, columns).
+
+        method : str, default="median"
+            Name of the kernel: "median", "sigma_clip", "minmax" or
+            "percentile_clip".
+
+        weights : list of float or None, default=None
+            One weight per frame for the average of the kept values (see
+            frame_weights). Ignored by "median".
+
+        mem_limit : float, default=2e8
+            Memory budget in bytes for the temporary blocks.
+
+        **kwargs
+            Passed to the kernel (e.g. low_thresh, nlow, high).
+
+    Returns
+    -------
+        combination : np.ndarray
+            2D float32 array.
+    """
+    if method not in KERNELS:
+        raise ValueError(f"Unknown combination method: {method}")
+
+    kernel = KERNELS[method]
+    combination = np.empty(cube.shape[1:], dtype=np.float32)
+
+    for block in row_blocks(cube.shape[1:], cube.shape[0], mem_limit=mem_limit,
+                            itemsize=cube.itemsize, overhead=4):
+        combination[block] = kernel(cube[:, block], weights=weights, **kwargs)
+
+    return combination
+
+
+def frame_weights(files, parameters):
+    """
+    Weights for a list of frames from the inspection parameters table (see
+    inspection.inspect): inverse of FWHM² · sky_sigma², which scales as the
+    inverse variance of a point source measure. Normalized to mean 1.
+
+    Parameters
+    ----------
+        files : list of str
+            Names of the frames (as in the "file" column).
+
+        parameters : pd.DataFrame
+            Parameters table with "file", "FWHM" and "sky_sigma" columns.
+
+    Returns
+    -------
+        weights : np.ndarray
+            1D array with one weight per frame.
+    """
+    pars = parameters.set_index("file").loc[list(files)]
+    weights = 1/(pars["FWHM"].to_numpy()**2 * pars["sky_sigma"].to_numpy()**2)
+
+    return weights/weights.mean()
+
+
+def combine_files(file_list, hdu=0, low_thresh=3, high_thresh=3, scaling=None, mem_limit=2e9):
+    """
+    Combine one extension of a list of FITS files with `sigma_clip_average`
+    processing the stack in row blocks under a memory budget.
+
+    Parameters
+    ----------
+        file_list : list of str
+            Paths to the files to combine.
+
+        hdu : int, default=0
+            Index of the extension to combine.
+
+        low_thresh, high_thresh : float, default=3
+            Clipping thresholds passed to `sigma_clip_average`.
+
+        scaling : function, list of values or None, default=None
+            Function applied to each full frame returning its scaling factor,
+            or the factors themselves.  Same meaning as
+            `ccdproc.Combiner.scaling`.
+
+        mem_limit : float, default=2e9
+            Memory budget in bytes for the stack of blocks.
+
+    Returns
+    -------
+        combination : np.ndarray
+            2D float32 array with the combined extension.
+    """
+    with ExitStack() as stack:
+        # Default memmap (None) maps the files when possible and falls back to
+        # plain reads for scaled (BZERO/BSCALE) images; sections are lazy
+        # either way.
+        hduls = [stack.enter_context(fits.open(file)) for file in file_list]
+        sections = [hdul[hdu].section for hdul in hduls]
+
+        shape = tuple(hduls[0][hdu].shape)
+        n_frames = len(sections)
+
+        if callable(scaling):
+            scaling = [scaling(np.asarray(section[:, :], dtype=np.float32)) for section in sections]
+
+        combination = np.empty(shape, dtype=np.float32)
+        blocks = row_blocks(shape, n_frames, mem_limit=mem_limit)
+        buffer = np.empty((n_frames, blocks[0].stop - blocks[0].start, shape[1]), dtype=np.float32)
+
+        for block in blocks:
+            cube = buffer[:, :block.stop - block.start]
+
+            for k, section in enumerate(sections):
+                cube[k] = section[block, :]
+
+            combination[block] = sigma_clip_average(cube,
+                                                    low_thresh=low_thresh,
+                                                    high_thresh=high_thresh,
+                                                    scaling=scaling)
+
+    return combination
@@ -0,0 +1,227 @@
+"""
+Routines to load FITS frames opening each file only once.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from astropy.io import fits
+
+
+def load_frame(path, ext=0, memmap=False, dtype=None):
+    """
+    Load data and header of a FITS extension with a single open of the file.
+
+    Parameters
+    ----------
+        path : str
+            Path to the FITS file.
+
+        ext : int, default=0
+            Index of the extension to load.
+
+        memmap : bool, default=False
+            If True the data is a memory mapped array, so pixels are only
+            read from disk when accessed. Scaled images (BZERO/BSCALE) can't
+            be mapped and are read as usual.
+
+        dtype : numpy dtype or None, default=None
+            If given the data is converted to this type (this reads the
+            whole array). Loaded (not memory mapped) data always comes in the
+            native byte order.
+
+    Returns
+    -------
+        data : np.ndarray
+            Image matrix.
+
+        header : astropy.io.fits.Header
+            Header of the extension.
+    """
+    #  memmap=None maps when possible, True would raise on scaled images
+    with fits.open(path, memmap=None if memmap else False) as hdul:
+        hdu = hdul[ext]
+        header = hdu.header
+        data = hdu.data
+
+        if dtype is not None:
+            data = np.asarray(data, dtype=dtype)
+        elif not memmap:
+            data = np.array(data, dtype=data.dtype.newbyteorder("="))
+
+    return data, header
+
+
+def file_hash(path):
+    """
+    Hash of the content of a file, to key caches of results computed from
+    it.
+
+    Parameters
+    ----------
+        path : str
+            Path to the file.
+
+    Returns
+    -------
+        digest : str
+            BLAKE2 hex digest of the file content.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def load_header(path, ext=0):
+    """
+    Load only the header of a FITS extension, without reading its data.
+
+    Parameters
+    ----------
+        path : str
+            Path to the FITS file.
+
+        ext : int, default=0
+            Index of the extension.
+
+    Returns
+    -------
+        header : astropy.io.fits.Header
+            Header of the extension.
+    """
+    with fits.open(path, lazy_load_hdus=True) as hdul:
+        header = hdul[ext].header
+
+    return header
+
+
+@contextmanager
+def open_frame(path, ext=0):
+    """
+    Context manager to open a FITS extension (memory mapped when possible)
+    for lazy section reads. Yields the HDU, whose `section` attribute reads only the requested
+    slices from disk (e.g. `hdu.section[100:200, 50:80]`), and the header.
+
+    Parameters
+    ----------
+        path : str
+            Path to the FITS file.
+
+        ext : int, default=0
+            Index of the extension.
+
+    Returns
+    -------
+        None.
+    """
+    with fits.open(path) as hdul:
+        yield hdul[ext], hdul[ext].header
+
+
+def read_section(path, rows, cols, ext=0):
+    """
+    Read a rectangular section of a FITS extension without loading the rest
+    of the image.
+
+    Parameters
+    ----------
+        path : str
+            Path to the FITS file.
+
+        rows, cols : slice
+            Slices in y and x.
+
+        ext : int, default=0
+            Index of the extension.
+
+    Returns
+    -------
+        section : np.ndarray
+            2D array with the pixels of the section.
+    """
+    with open_frame(path, ext=ext) as (hdu, _):
+        section = hdu.section[rows, cols]
+
+    return section
+
+
+class FrameCache:
+    """
+    Thread safe LRU cache of decoded frames (float32 data and header) bounded
+    by the total size in bytes of the cached arrays.
+
+    Frames are loaded with load_frame on the first request and shared (read
+    only) by the callers. Concurrent requests of a frame being loaded wait for
+    that load instead of reading the file again.
+
+    Parameters
+    ----------
+        max_bytes : float, default=2e9
+            Maximum size of the cached arrays. The most recently used frame is
+            always kept, even if larger.
+    """
+
+    def __init__(self, max_bytes=2e9):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Return (data, header) of a frame, loading it if needed.
+
+        Parameters
+        ----------
+            path : str
+                Path to the FITS file.
+
+        Returns
+        -------
+            data : np.ndarray
+                Read only float32 image matrix.
+
+            header : astropy.io.fits.Header
+                Header of the primary extension (shared, copy before
+                modifying).
+        """
+        while True:
+            with self._lock:
+                if path in self._frames:
+                    self._frames.move_to_end(path)
+                    self.hits += 1
+                    return self._frames[path]
+
+                event = self._loading.get(path)
+                if event is None:
+                    self._loading[path] = threading.Event()
+                    self.misses += 1
+                    break
+
+            # Another thread is loading it
+            event.wait()
+
+        try:
+            data, header = load_frame(path, dtype=np.float32)
+            data.flags.writeable = False
+
+            with self._lock:
+                self._frames[path] = (data, header)
+                self.nbytes += data.nbytes
+
+                while self.nbytes > self.max_bytes and len(self._frames) > 1:
+                    _, (old, _) = self._frames.popitem(last=False)
+                    self.nbytes -= old.nbytes
+        finally:
+            with self._lock:
+                self._loading.pop(path).set()
+
+        return data, header